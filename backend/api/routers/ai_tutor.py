@@ -5,7 +5,7 @@ to keep the backend surface area small and easier to maintain.
 """
 
 from fastapi import APIRouter, HTTPException, Depends, Header
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, Response
 from pydantic import BaseModel, Field
 from typing import List, Optional, Dict, Any
 from sqlalchemy.orm import Session
@@ -16,7 +16,7 @@ import json
 import os
 
 from app.db import get_db
-from app.auth import get_current_user, get_user_id_from_authorization_header
+from app.auth import get_current_user, get_current_admin_user, get_user_id_from_authorization_header
 from domain.ai import get_hybrid_tutor, get_hybrid_analyzer, get_qdrant_tutor
 from infra.utils.llm_utils import get_groq_client
 from infra.analysis.ast_analysis import build_ast_graph
@@ -71,6 +71,15 @@ class HintResponse(BaseModel):
 	strategy: str
 
 
+class HintBatchRequest(BaseModel):
+	"""Yêu cầu gợi ý cho nhiều bài nộp của cùng 1 bài (chấm cả lớp)"""
+	codes: List[str] = Field(min_length=1, max_length=200)
+	problem_id: str
+	problem_description: str = ""
+	hint_level: int = Field(default=1, ge=1, le=5)
+	language: str = "vi"
+
+
 class ChatRequest(BaseModel):
 	"""Yêu cầu chat với gia sư"""
 	code: str
@@ -231,6 +240,28 @@ async def get_hint(
 		raise HTTPException(status_code=500, detail=str(e))
 
 
+@router.post("/hint/batch")
+async def get_hint_batch(
+	request: HintBatchRequest,
+	admin=Depends(get_current_admin_user),
+):
+	"""Gợi ý cho nhiều bài nộp; trả về dạng cột (mỗi field là 1 mảng, phần tử i ứng với codes[i]) + summary."""
+	try:
+		tutor = get_hybrid_tutor()
+		batch = await tutor.generate_feedback_batch(
+			codes=request.codes,
+			problem_id=str(request.problem_id),
+			problem_description=request.problem_description,
+			hint_level=request.hint_level,
+			language=request.language,
+		)
+		# Serialize cả batch 1 lần bằng orjson (numpy columns), không qua response_model
+		return Response(content=batch.to_json(), media_type="application/json")
+	except Exception as e:
+		logger.error(f"Hint batch error: {e}")
+		raise HTTPException(status_code=500, detail=str(e))
+
+
 class HintFeedbackRequest(BaseModel):
 	interaction_id: int
 	was_helpful: bool
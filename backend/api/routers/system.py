@@ -4,15 +4,18 @@
 from __future__ import annotations
 
 import asyncio
-import json
+import functools
 import logging
 import os
-from typing import Optional
+import socket
+import sys
+from typing import Dict, Optional
 
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect
 from pydantic import BaseModel
 import websockets
 import httpx
+import orjson
 
 from infra.services import DockerManager
 from app.settings import (
@@ -23,6 +26,7 @@ from app.settings import (
 	EXEC_NETWORK_ACCESS,
 	EXEC_TIMEOUT_SECONDS,
 	ENABLE_WS_TERMINAL,
+	SANDBOX_WS_OPEN_TIMEOUT,
 )
 
 logger = logging.getLogger(__name__)
@@ -32,6 +36,144 @@ router = APIRouter(tags=["system"])
 # Docker manager instance
 _docker_manager = DockerManager()
 
+# Giới hạn gộp message khi forward output về client (tránh 1 frame quá lớn).
+_WS_BATCH_MAX_BYTES = 64 * 1024
+_WS_BATCH_MAX_ITEMS = 128
+# Buffer đọc từ Docker attach socket.
+_ATTACH_RECV_BYTES = 64 * 1024
+# Envelope cố định của message start gửi sang sandbox; chỉ phần code cần encode mỗi lần.
+_START_PREFIX = b'{"type":"start","code":'
+
+
+# HTTP client dùng chung tới sandbox /run (giữ keep-alive, tránh handshake mỗi request).
+# Tách theo event loop: AsyncClient gắn với loop tạo ra nó.
+_SANDBOX_HTTP: Dict[int, httpx.AsyncClient] = {}
+
+
+@functools.lru_cache(maxsize=1)
+def _sandbox_urls(base: str) -> tuple[str, str]:
+    """Derive (ws_url, http_run_url) từ URL của Sandbox Service."""
+    base = base.strip()
+    if base.startswith("http://"):
+        ws_url = base.replace("http://", "ws://", 1) + "/terminal"
+    elif base.startswith("https://"):
+        ws_url = base.replace("https://", "wss://", 1) + "/terminal"
+    else:
+        # Assume https if no scheme
+        ws_url = f"wss://{base}/terminal" if "://" not in base else f"{base}/terminal"
+    return ws_url, base.rstrip('/') + '/run'
+
+
+def _get_sandbox_http() -> httpx.AsyncClient:
+    loop_id = id(asyncio.get_running_loop())
+    client = _SANDBOX_HTTP.get(loop_id)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            timeout=httpx.Timeout(60.0),
+            limits=httpx.Limits(max_keepalive_connections=32, max_connections=128),
+        )
+        _SANDBOX_HTTP[loop_id] = client
+    return client
+
+
+async def close_sandbox_http() -> None:
+    """Đóng HTTP client của loop hiện tại (gọi khi app shutdown)."""
+    client = _SANDBOX_HTTP.pop(id(asyncio.get_running_loop()), None)
+    if client is not None:
+        await client.aclose()
+
+
+def _parse_envelope(data: str) -> Optional[dict]:
+    """Parse message dạng JSON {"type": ...} từ client; None nếu là raw text.
+
+    Phần lớn message là phím gõ thô -> kiểm tra prefix trước để khỏi gọi JSON parser.
+    """
+    if not data or data[0] != "{" or '"type"' not in data:
+        return None
+    try:
+        parsed = orjson.loads(data)
+    except orjson.JSONDecodeError:
+        return None
+    return parsed if isinstance(parsed, dict) else None
+
+
+def _as_bytes(data) -> bytes:
+    if isinstance(data, str):
+        return data.encode('utf-8')
+    return data
+
+
+def _drain_ready(queue: asyncio.Queue, first: bytes) -> tuple[bytes, bool]:
+    """Gộp `first` với các message đang chờ sẵn trong queue (không await).
+
+    Trả về (payload, eof) - eof=True nếu gặp sentinel None (nguồn đã đóng).
+    """
+    parts = [first]
+    size = len(first)
+    while size < _WS_BATCH_MAX_BYTES and len(parts) < _WS_BATCH_MAX_ITEMS:
+        try:
+            nxt = queue.get_nowait()
+        except asyncio.QueueEmpty:
+            break
+        if nxt is None:
+            return b"".join(parts), True
+        chunk = _as_bytes(nxt)
+        parts.append(chunk)
+        size += len(chunk)
+    return b"".join(parts), False
+
+
+def _input_payload(data: str) -> str:
+    """Phần input cần gửi vào chương trình: raw text hoặc data của envelope {"type": "input"}."""
+    msg = _parse_envelope(data)
+    if msg is None:
+        return data
+    if msg.get("type") == "input":
+        return msg.get("data", "")
+    return ""
+
+
+async def _pump_input(websocket: WebSocket, pending: asyncio.Queue) -> None:
+    """Đọc liên tục input từ client vào queue (bytes, đã bóc envelope); None khi websocket đóng."""
+    try:
+        while True:
+            pending.put_nowait(_input_payload(await websocket.receive_text()).encode('utf-8'))
+    except Exception as e:
+        logger.debug(f"client input ended: {e}")
+    finally:
+        pending.put_nowait(None)
+
+
+async def _receive_input_batch(pending: asyncio.Queue) -> Optional[bytes]:
+    """Chờ 1 message input rồi gộp các message đã tới sẵn (không chờ thêm); None khi client đã đóng.
+
+    Phím gõ lẻ đi ngay; burst (paste, gõ nhanh) dồn lại trong queue khi đang gửi batch trước.
+    """
+    data = await pending.get()
+    if data is None:
+        return None
+    payload, eof = _drain_ready(pending, data)
+    if eof:
+        # Giữ sentinel cho lần gọi sau
+        pending.put_nowait(None)
+    return payload
+
+
+async def _run_until_first_done(*coros) -> None:
+    """Chạy song song các coroutine; 1 cái kết thúc (disconnect) thì huỷ các cái còn lại."""
+    async with asyncio.TaskGroup() as tg:
+        tasks = []
+
+        def _cancel_others(done_task: asyncio.Task) -> None:
+            for t in tasks:
+                if t is not done_task:
+                    t.cancel()
+
+        for coro in coros:
+            task = tg.create_task(coro)
+            task.add_done_callback(_cancel_others)
+            tasks.append(task)
+
 
 class HealthResponse(BaseModel):
     status: str
@@ -67,15 +209,8 @@ async def websocket_terminal(websocket: WebSocket):
 
     # CASE 1: PROXY MODE (Kết nối sang Sandbox Service)
     if _docker_manager.sandbox_url:
-        # Derive WebSocket URL từ HTTP URL
-        sandbox_base = _docker_manager.sandbox_url.strip()
-        if sandbox_base.startswith("http://"):
-            sandbox_ws_url = sandbox_base.replace("http://", "ws://", 1) + "/terminal"
-        elif sandbox_base.startswith("https://"):
-            sandbox_ws_url = sandbox_base.replace("https://", "wss://", 1) + "/terminal"
-        else:
-            # Assume https if no scheme
-            sandbox_ws_url = f"wss://{sandbox_base}/terminal" if "://" not in sandbox_base else f"{sandbox_base}/terminal"
+        # Derive WebSocket URL từ HTTP URL (cache, URL không đổi trong process)
+        sandbox_ws_url, http_url = _sandbox_urls(_docker_manager.sandbox_url)
         
         logger.info(f"Proxying terminal websocket to sandbox: {sandbox_ws_url}")
         
@@ -83,7 +218,7 @@ async def websocket_terminal(websocket: WebSocket):
             # Đợi message "start" từ client trước
             init_msg = await websocket.receive_text()
             try:
-                obj = json.loads(init_msg)
+                obj = orjson.loads(init_msg)
                 if obj.get("type") != "start" or "code" not in obj:
                     await websocket.send_text("ERROR: expected start message with code")
                     await websocket.close()
@@ -99,19 +234,18 @@ async def websocket_terminal(websocket: WebSocket):
             # Non-interactive: call sandbox HTTP /run và forward kết quả, tránh mở shell
             if not interactive:
                 try:
-                    http_url = sandbox_base.rstrip('/') + '/run'
                     logger.debug(f"Calling sandbox HTTP /run at {http_url}")
-                    async with httpx.AsyncClient(timeout=60.0) as client:
-                        resp = await client.post(http_url, json={"code": code, "stdin": stdin_input or ""})
-                        if resp.status_code != 200:
-                            await websocket.send_text(f"ERROR: Sandbox /run returned {resp.status_code}")
-                        else:
-                            data = resp.json()
-                            # Gửi stdout, stderr và thông báo kết quả
-                            if data.get("stdout"):
-                                await websocket.send_text(data.get("stdout"))
-                            if data.get("stderr"):
-                                await websocket.send_text(data.get("stderr"))
+                    client = _get_sandbox_http()
+                    resp = await client.post(http_url, json={"code": code, "stdin": stdin_input or ""})
+                    if resp.status_code != 200:
+                        await websocket.send_text(f"ERROR: Sandbox /run returned {resp.status_code}")
+                    else:
+                        data = resp.json()
+                        # Gửi stdout, stderr và thông báo kết quả
+                        if data.get("stdout"):
+                            await websocket.send_text(data.get("stdout"))
+                        if data.get("stderr"):
+                            await websocket.send_text(data.get("stderr"))
                 except Exception as e:
                     logger.error(f"Sandbox HTTP run error: {e}")
                     try:
@@ -126,55 +260,70 @@ async def websocket_terminal(websocket: WebSocket):
                 return
             
             # Kết nối đến sandbox service với timeout
-            open_timeout = float(os.getenv("SANDBOX_WS_OPEN_TIMEOUT", "60"))
-            logger.debug(f"Connecting to sandbox WebSocket with timeout={open_timeout}s")
+            logger.debug(f"Connecting to sandbox WebSocket with timeout={SANDBOX_WS_OPEN_TIMEOUT}s")
             
             async with websockets.connect(
                 sandbox_ws_url,
-                open_timeout=open_timeout,
+                open_timeout=SANDBOX_WS_OPEN_TIMEOUT,
                 close_timeout=10,
                 ping_interval=20,
                 ping_timeout=10,
             ) as sandbox_ws:
-                # Gửi JSON start đến sandbox để chạy python trực tiếp
-                await sandbox_ws.send(json.dumps({"type": "start", "code": code}))
+                # Gửi JSON start đến sandbox để chạy python trực tiếp.
+                # Gửi bytes (binary frame): sandbox nhận cả text lẫn binary, không cần decode ở đây.
+                await sandbox_ws.send(_START_PREFIX + orjson.dumps(code) + b"}")
                 
                 async def forward_client_to_sandbox():
+                    pending: asyncio.Queue = asyncio.Queue()
+                    pump_task = asyncio.create_task(_pump_input(websocket, pending))
                     try:
                         while True:
-                            data = await websocket.receive_text()
-                            # Parse nếu là JSON message (input từ client)
-                            try:
-                                msg = json.loads(data)
-                                if msg.get("type") == "input":
-                                    # Gửi input data sang sandbox (raw text)
-                                    input_data = msg.get("data", "")
-                                    await sandbox_ws.send(input_data)
-                            except:
-                                # Nếu không phải JSON, gửi thẳng
-                                await sandbox_ws.send(data)
+                            # Gom input đã tới (raw text hoặc {type: input}) thành 1 frame
+                            input_data = await _receive_input_batch(pending)
+                            if input_data is None:
+                                break
+                            if input_data:
+                                await sandbox_ws.send(input_data)
                     except Exception as e:
                         logger.debug(f"forward_client_to_sandbox error: {e}")
+                    finally:
+                        pump_task.cancel()
 
                 async def forward_sandbox_to_client():
+                    # Tách nhận/gửi: pump đọc liên tục từ sandbox vào queue,
+                    # vòng gửi gộp mọi message đang chờ thành 1 frame duy nhất.
+                    pending: asyncio.Queue = asyncio.Queue()
+
+                    async def pump_sandbox():
+                        try:
+                            while True:
+                                pending.put_nowait(await sandbox_ws.recv())
+                        except Exception as e:
+                            logger.debug(f"sandbox recv ended: {e}")
+                        finally:
+                            pending.put_nowait(None)
+
+                    pump_task = asyncio.create_task(pump_sandbox())
                     try:
                         while True:
-                            data = await sandbox_ws.recv()
-                            # Sandbox gửi về text/bytes, forward về client
-                            if isinstance(data, bytes):
-                                await websocket.send_text(data.decode('utf-8', errors='replace'))
-                            else:
-                                await websocket.send_text(data)
+                            data = await pending.get()
+                            if data is None:
+                                break
+                            # Forward dạng binary frame: client (xterm) tự decode UTF-8,
+                            # server không phải decode/validate lại output terminal
+                            payload, eof = _drain_ready(pending, _as_bytes(data))
+                            await websocket.send_bytes(payload)
+                            if eof:
+                                break
+                            # Nhường event loop giữa các batch
+                            await asyncio.sleep(0)
                     except Exception as e:
                         logger.debug(f"forward_sandbox_to_client error: {e}")
+                    finally:
+                        pump_task.cancel()
 
-                # Chạy song song 2 luồng
-                task1 = asyncio.create_task(forward_client_to_sandbox())
-                task2 = asyncio.create_task(forward_sandbox_to_client())
-                
-                # Đợi 1 trong 2 luồng kết thúc (disconnect)
-                done, pending = await asyncio.wait([task1, task2], return_when=asyncio.FIRST_COMPLETED)
-                for t in pending: t.cancel()
+                # Chạy song song 2 luồng, 1 luồng kết thúc (disconnect) thì dừng luồng còn lại
+                await _run_until_first_done(forward_client_to_sandbox(), forward_sandbox_to_client())
 
         except Exception as e:
             logger.error(f"Proxy Terminal Error: {e}")
@@ -193,7 +342,7 @@ async def websocket_terminal(websocket: WebSocket):
     try:
         init_msg = await websocket.receive_text()
         try:
-            obj = json.loads(init_msg)
+            obj = orjson.loads(init_msg)
             if obj.get("type") != "start" or "code" not in obj:
                 await websocket.send_text("ERROR: expected start message with code")
                 await websocket.close()
@@ -215,15 +364,52 @@ async def websocket_terminal(websocket: WebSocket):
         # Dùng running loop để tránh warning/deprecation.
         loop = asyncio.get_running_loop()
 
+        # Socket thật (Linux/macOS): dùng I/O non-blocking của event loop, không qua thread pool.
+        # Windows (named pipe / ProactorEventLoop) không hỗ trợ -> giữ đường executor.
+        use_loop_io = isinstance(sock_reader, socket.socket) and sys.platform != "win32"
+        if use_loop_io:
+            sock_reader.setblocking(False)
+
+        async def sock_recv(nbytes: int) -> bytes:
+            if use_loop_io:
+                return await loop.sock_recv(sock_reader, nbytes)
+            return await loop.run_in_executor(None, sock_reader.recv, nbytes)
+
+        async def sock_sendall(payload: bytes) -> None:
+            if use_loop_io:
+                await loop.sock_sendall(sock_reader, payload)
+            else:
+                await loop.run_in_executor(None, sock_reader.sendall, payload)
+
+        def drain_ready(chunks: list) -> bool:
+            """Đọc thêm (non-blocking) phần output đã sẵn trong socket. Trả về True nếu gặp EOF."""
+            size = sum(len(c) for c in chunks)
+            while size < _WS_BATCH_MAX_BYTES:
+                try:
+                    more = sock_reader.recv(_ATTACH_RECV_BYTES)
+                except (BlockingIOError, InterruptedError):
+                    return False
+                if not more:
+                    return True
+                chunks.append(more)
+                size += len(more)
+            return False
+
         async def read_from_container():
-            """Đọc output từ container và gửi về WebSocket."""
+            """Đọc output từ container và gửi về WebSocket (binary frame, không decode)."""
             try:
                 while True:
-                    data = await loop.run_in_executor(None, sock_reader.recv, 4096)
+                    data = await sock_recv(_ATTACH_RECV_BYTES)
                     if not data:
                         break
-                    text = data.decode("utf-8", errors="ignore") if isinstance(data, bytes) else str(data)
-                    await websocket.send_text(text)
+                    # Gộp mọi output đang chờ thành 1 frame; byte UTF-8 bị cắt giữa
+                    # 2 frame được xterm ghép lại ở client
+                    chunks = [data]
+                    eof = drain_ready(chunks) if use_loop_io else False
+                    await websocket.send_bytes(b"".join(chunks))
+                    if eof:
+                        break
+                    await asyncio.sleep(0)
             except Exception:
                 pass
             finally:
@@ -234,37 +420,26 @@ async def websocket_terminal(websocket: WebSocket):
 
         async def read_from_websocket():
             """Đọc input từ WebSocket và gửi vào container."""
+            pending: asyncio.Queue = asyncio.Queue()
+            pump_task = asyncio.create_task(_pump_input(websocket, pending))
             try:
                 while True:
-                    msg = await websocket.receive_text()
-                    if not msg:
-                        continue
-
-                    # Parse message (có thể là JSON {type: input, data: ...} hoặc raw text)
-                    input_data = msg
-                    try:
-                        parsed = json.loads(msg)
-                        if isinstance(parsed, dict) and parsed.get("type") == "input":
-                            input_data = parsed.get("data", "")
-                    except (json.JSONDecodeError, TypeError):
-                        pass
+                    # Message có thể là JSON {type: input, data: ...} hoặc raw text; gom burst thành 1 lần ghi
+                    input_data = await _receive_input_batch(pending)
+                    if input_data is None:
+                        return
 
                     if input_data:
                         try:
-                            sock_writer = getattr(sock, "_sock", sock)
-                            await loop.run_in_executor(None, sock_writer.sendall, input_data.encode("utf-8"))
+                            await sock_sendall(input_data)
                         except Exception:
                             pass
             except (WebSocketDisconnect, Exception):
                 return
+            finally:
+                pump_task.cancel()
 
-        reader_task = asyncio.create_task(read_from_container())
-        ws_task = asyncio.create_task(read_from_websocket())
-
-        done, pending = await asyncio.wait([reader_task, ws_task], return_when=asyncio.FIRST_COMPLETED)
-
-        for t in pending:
-            t.cancel()
+        await _run_until_first_done(read_from_container(), read_from_websocket())
 
     except WebSocketDisconnect:
         pass
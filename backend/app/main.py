@@ -6,6 +6,7 @@ from fastapi.middleware.cors import CORSMiddleware
 
 from infra.services import DockerManager
 from infra.services.scheduler import get_scheduler
+from api.routers.system import close_sandbox_http
 from api.routers import (
     admin_router,
     ai_tutor_router,
@@ -79,6 +80,12 @@ async def shutdown_event():
     await scheduler.stop()
     logger.info("Qdrant Scheduler stopped")
 
+    # Flush các point đang chờ bulk-upsert trước khi thoát
+    from domain.ai.qdrant_rag import shutdown_qdrant_tutor
+    await shutdown_qdrant_tutor()
+
+    await close_sandbox_http()
+
 
 app.include_router(auth_router)
 app.include_router(problems_router)
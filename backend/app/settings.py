@@ -68,6 +68,8 @@ QDRANT_IMPORT_MAX_RECORDS: int = 5000
 # WebSocket interactive terminal
 # Endpoint này cho phép chạy code tương tác trong Docker sandbox.
 ENABLE_WS_TERMINAL: bool = os.getenv("ENABLE_WS_TERMINAL", "true").lower() in ("1", "true", "yes", "y")
+# Timeout (giây) khi mở WebSocket tới Sandbox Service (proxy mode).
+SANDBOX_WS_OPEN_TIMEOUT: float = float(os.getenv("SANDBOX_WS_OPEN_TIMEOUT", "60"))
 
 # AI warm-up
 # Embedding model (SentenceTransformer) khá nặng, lần đầu load sẽ chậm
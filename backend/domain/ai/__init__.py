@@ -2,7 +2,7 @@
 
 from .qdrant_rag import QdrantTutor, get_qdrant_tutor, RetrievedCode
 from .analyzer import HybridCodeAnalyzer, get_hybrid_analyzer, HybridAnalysisResult
-from .tutor import HybridTutor, get_hybrid_tutor, TutorFeedback
+from .tutor import HybridTutor, get_hybrid_tutor, TutorFeedback, TutorFeedbackBatch
 
 __all__ = [
     'QdrantTutor',
@@ -13,5 +13,6 @@ __all__ = [
     'HybridAnalysisResult',
     'HybridTutor',
     'get_hybrid_tutor',
-    'TutorFeedback'
+    'TutorFeedback',
+    'TutorFeedbackBatch'
 ]
@@ -76,9 +76,14 @@ class HybridAnalysisResult:
     concepts_involved: List[str] = None
     suggested_fix: str = ""
     
+    # Tóm tắt cấu trúc (như get_code_structure_summary), dựng từ chính ast_analysis
+    code_structure: Dict[str, Any] = None
+    
     def __post_init__(self):
         if self.concepts_involved is None:
             self.concepts_involved = []
+        if self.code_structure is None:
+            self.code_structure = {}
 
 
 class EnhancedASTVisitor(ast.NodeVisitor):
@@ -388,7 +393,8 @@ class HybridCodeAnalyzer:
         ast_result = self.analyze_ast(code)
         
         result = HybridAnalysisResult(
-            ast_analysis=ast_result
+            ast_analysis=ast_result,
+            code_structure=self._structure_summary(ast_result)
         )
         
         # Nếu có lỗi syntax, trả về ngay
@@ -447,8 +453,11 @@ class HybridCodeAnalyzer:
         """
         Lấy tóm tắt cấu trúc code để hiển thị cho user.
         """
-        ast_result = self.analyze_ast(code)
-        
+        return self._structure_summary(self.analyze_ast(code))
+    
+    @staticmethod
+    def _structure_summary(ast_result: ASTAnalysisResult) -> Dict[str, Any]:
+        """Tóm tắt cấu trúc từ kết quả analyze_ast đã có (không parse lại code)."""
         if not ast_result.valid_syntax:
             return {
                 "valid": False,
@@ -0,0 +1,109 @@
+"""
+Feedback Cache - Cache phản hồi LLM cho các bài nộp gần giống nhau.
+2 tầng: exact (hash của code đã normalize + đổi tên biến) và semantic (cosine của embedding truy vấn).
+"""
+
+from typing import List, Optional, Tuple
+from dataclasses import dataclass, field
+from hashlib import blake2b
+import threading
+import time
+
+import numpy as np
+from cachetools import TTLCache
+
+EXACT_CACHE_SIZE = 10_000
+CACHE_TTL_SECONDS = 3600
+# Cosine (embedding đã normalize -> dot product) tối thiểu để coi là "cùng một bài nộp"
+SEMANTIC_THRESHOLD = 0.97
+# Số entry tối đa / (problem_id, hint_level, language, digest ngữ cảnh); đầy thì ghi đè entry cũ nhất
+SEMANTIC_BUCKET_SIZE = 256
+# Số key (bucket) tối đa: digest ngữ cảnh đổi theo từng bước hội thoại -> mỗi bước 1 bucket mới.
+# Bucket hết hạn sau TTL kể từ lần put cuối (lúc đó mọi entry trong nó cũng đã hết hạn); đầy thì bỏ bucket ít dùng nhất
+SEMANTIC_MAX_KEYS = 2048
+
+# (problem_id, hint_level, language, digest của đề bài + các hint trước)
+CacheKey = Tuple[str, int, str, bytes]
+
+
+@dataclass
+class _SemanticBucket:
+    """Các entry của 1 key: ma trận embedding [N, D] float32 + list feedback song song."""
+    vectors: np.ndarray
+    feedbacks: List[object] = field(default_factory=list)
+    expires: List[float] = field(default_factory=list)
+    next_slot: int = 0
+
+
+class FeedbackCache:
+    """Cache TutorFeedback theo (problem_id, hint_level, language, ngữ cảnh prompt) + nội dung code."""
+
+    def __init__(
+        self,
+        maxsize: int = EXACT_CACHE_SIZE,
+        ttl: float = CACHE_TTL_SECONDS,
+        threshold: float = SEMANTIC_THRESHOLD,
+        bucket_size: int = SEMANTIC_BUCKET_SIZE,
+        max_keys: int = SEMANTIC_MAX_KEYS,
+    ):
+        self._exact: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._semantic: TTLCache = TTLCache(maxsize=max_keys, ttl=ttl)
+        self._ttl = ttl
+        self._threshold = threshold
+        self._bucket_size = bucket_size
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _digest(key_code: str) -> bytes:
+        return blake2b(key_code.encode("utf-8"), digest_size=16).digest()
+
+    def get_exact(self, key: CacheKey, key_code: str):
+        with self._lock:
+            return self._exact.get((*key, self._digest(key_code)))
+
+    def get_similar(self, key: CacheKey, query_vector) -> Optional[object]:
+        """Feedback của entry có cosine cao nhất với query_vector (>= threshold), None nếu không có."""
+        with self._lock:
+            bucket = self._semantic.get(key)
+            if bucket is None or not bucket.feedbacks:
+                return None
+            # 1 phép nhân ma trận-vector cho toàn bộ entry của key
+            scores = bucket.vectors @ np.asarray(query_vector, dtype=np.float32)
+            now = time.monotonic()
+            for idx in np.argsort(scores)[::-1]:
+                if scores[idx] < self._threshold:
+                    return None
+                if bucket.expires[idx] > now:
+                    return bucket.feedbacks[idx]
+            return None
+
+    def put(self, key: CacheKey, key_code: str, query_vector, feedback) -> None:
+        vector = np.asarray(query_vector, dtype=np.float32)
+        expires = time.monotonic() + self._ttl
+        with self._lock:
+            self._exact[(*key, self._digest(key_code))] = feedback
+
+            bucket = self._semantic.get(key)
+            if bucket is None:
+                bucket = _SemanticBucket(vectors=np.empty((0, vector.shape[0]), dtype=np.float32))
+            # Gán lại mỗi lần put: làm mới TTL của bucket
+            self._semantic[key] = bucket
+
+            if len(bucket.feedbacks) < self._bucket_size:
+                bucket.vectors = np.vstack([bucket.vectors, vector[None, :]])
+                bucket.feedbacks.append(feedback)
+                bucket.expires.append(expires)
+            else:
+                slot = bucket.next_slot
+                bucket.vectors[slot] = vector
+                bucket.feedbacks[slot] = feedback
+                bucket.expires[slot] = expires
+                bucket.next_slot = (slot + 1) % self._bucket_size
+
+    def invalidate_problem(self, problem_id: str) -> None:
+        """Xoá mọi entry của 1 bài (vd. khi đề bài / code mẫu thay đổi)."""
+        with self._lock:
+            for exact_key in [k for k in self._exact.keys() if k[0] == problem_id]:
+                self._exact.pop(exact_key, None)
+            for key in [k for k in self._semantic.keys() if k[0] == problem_id]:
+                self._semantic.pop(key, None)
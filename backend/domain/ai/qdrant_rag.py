@@ -3,11 +3,18 @@ Qdrant Cloud RAG Module - Vector DB và Embedding
 Tích hợp với Qdrant Cloud để lưu trữ và truy xuất code mẫu + reference code
 """
 
-from qdrant_client import QdrantClient
+from qdrant_client import QdrantClient, AsyncQdrantClient
 from qdrant_client.http import models
 from infra.utils.normalize_code import normalize_code
-from typing import List, Dict, Optional, Any
+from typing import List, Dict, Optional, Any, Tuple
 from dataclasses import dataclass, field
+from collections import OrderedDict
+from functools import lru_cache, partial
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import asyncio
+import threading
 import uuid
 import os
 import re
@@ -18,6 +25,35 @@ logger = logging.getLogger(__name__)
 
 MAX_CHUNK_SIZE = 800
 VECTOR_SIZE = 384
+# Sử dụng all-MiniLM-L6-v2 như một giải pháp thay thế nhẹ cho CodeBERT
+# trong môi trường resource-constrained, nhưng vẫn đảm bảo semantic search tốt.
+EMBEDDING_MODEL = 'all-MiniLM-L6-v2'
+# Số full_code (kèm bản normalize) được cache theo submission (source_id); full_code không bao giờ đổi.
+FULL_CODE_CACHE_SIZE = 4096
+# Payload cần cho kết quả search; full_code (cả file) nằm ở collection meta, lấy riêng và cache.
+SEARCH_PAYLOAD_FIELDS = [
+    "problem_id", "code", "chunk_idx", "is_passed", "user_uuid", "total_chunks", "algo_type", "source_id",
+]
+# Số code truy vấn (normalize + embedding) được cache; sinh viên thường query lại cùng code.
+QUERY_CACHE_SIZE = 1024
+# Gom point từ nhiều submission rồi upsert 1 lần: flush khi đủ số point, khi không còn submission nào
+# đang encode (sắp vào hàng đợi) hoặc hết thời gian chờ (giây).
+UPSERT_BATCH_MAX_POINTS = 512
+UPSERT_BATCH_MAX_DELAY = 0.2
+UPSERT_MAX_ATTEMPTS = 3
+
+# Scalar quantization INT8: giữ bản quantized trong RAM, vector gốc (float32) trên disk để rescore.
+QUANTIZATION_CONFIG = models.ScalarQuantization(
+    scalar=models.ScalarQuantizationConfig(
+        type=models.ScalarType.INT8,
+        quantile=0.99,
+        always_ram=True,
+    )
+)
+# Search trên vector quantized, lấy dư x2 rồi rescore bằng vector gốc để giữ recall.
+QUANTIZED_SEARCH_PARAMS = models.SearchParams(
+    quantization=models.QuantizationSearchParams(rescore=True, oversampling=2.0)
+)
 
 
 @dataclass
@@ -33,9 +69,100 @@ class RetrievedCode:
     total_chunks: int = 1
     full_code: str = ""
     algo_type: str = "unknown"
+    source_id: str = ""  # id bản ghi trong collection meta (rỗng với point cũ lưu full_code trong payload)
     metadata: Dict[str, Any] = field(default_factory=dict)
 
 
+# Model embedding sống trong process worker (không tranh GIL với event loop của API)
+_embed_model = None
+
+
+def _load_embed_model():
+    """Initializer của process embedding: load SentenceTransformer 1 lần cho cả vòng đời worker."""
+    global _embed_model
+    try:
+        import torch
+        # 1 worker, 1 thread: tránh oversubscription CPU với process API
+        torch.set_num_threads(1)
+    except Exception:
+        pass
+    from sentence_transformers import SentenceTransformer
+    _embed_model = SentenceTransformer(EMBEDDING_MODEL)
+
+
+def _encode_batch(texts: List[str]):
+    """Chạy trong worker: encode cả batch -> ma trận float32 [len(texts), VECTOR_SIZE] (đã normalize)."""
+    return _embed_model.encode(
+        texts,
+        batch_size=32,
+        convert_to_numpy=True,
+        normalize_embeddings=True,
+    )
+
+
+def _ping_embed_worker() -> bool:
+    return _embed_model is not None
+
+
+@lru_cache(maxsize=1024)
+def _detect_algo_type(code: str) -> str:
+    """Recursive / iterative / sequential, duyệt AST 1 lần; cache cho code nộp lại y hệt."""
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return "unknown"
+
+    func_names = set()
+    called_names = []
+    has_loops = False
+    for node in ast.walk(tree):
+        if isinstance(node, ast.FunctionDef):
+            func_names.add(node.name)
+        # Check Iterative
+        elif isinstance(node, (ast.For, ast.While)):
+            has_loops = True
+        # Ghi lại lời gọi, xét đệ quy sau khi đã biết hết tên hàm
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+            called_names.append(node.func.id)
+
+    if any(name in func_names for name in called_names):
+        return "recursive"
+    if has_loops:
+        return "iterative"
+    return "sequential"
+
+
+def _split_lines(text: str) -> List[str]:
+    """Chia block dài theo dòng thành các chunk <= MAX_CHUNK_SIZE (gom list, không nối chuỗi lặp)."""
+    chunks = []
+    parts: List[str] = []
+    size = 0  # = len("\n".join(parts))
+    for line in text.split('\n'):
+        if size + 1 + len(line) > MAX_CHUNK_SIZE:
+            if size:
+                chunks.append("\n".join(parts).strip())
+            parts, size = [line], len(line)
+        elif size:
+            parts.append(line)
+            size += 1 + len(line)
+        else:
+            parts, size = [line], len(line)
+    if size:
+        chunks.append("\n".join(parts).strip())
+    return chunks
+
+
+class _FuncSpans(ast.NodeVisitor):
+    """Thu khoảng dòng [lineno-1, end_lineno) của các hàm ngoài cùng, 1 lượt duyệt AST."""
+
+    def __init__(self):
+        self.spans: List[Tuple[int, int]] = []
+
+    def visit_FunctionDef(self, node: ast.FunctionDef):
+        # Không duyệt tiếp: hàm lồng đã nằm trong chunk của hàm cha
+        self.spans.append((node.lineno - 1, node.end_lineno))
+
+
 class QdrantTutor:
     """
     Hệ thống RAG sử dụng Qdrant Cloud.
@@ -47,6 +174,8 @@ class QdrantTutor:
     """
 
     COLLECTION_SUBMISSIONS = "student_submissions"
+    # 1 bản ghi / submission (full_code + metadata), các chunk trỏ tới qua payload source_id
+    COLLECTION_SUBMISSION_META = "student_submissions_meta"
     
     def __init__(self):
         """Khởi tạo Qdrant client và embedding model"""
@@ -58,24 +187,184 @@ class QdrantTutor:
                 url=qdrant_url,
                 api_key=qdrant_api_key,
             )
+            # Client async (cùng cluster) cho các đường gọi từ event loop
+            self.aclient: Optional[AsyncQdrantClient] = AsyncQdrantClient(
+                url=qdrant_url,
+                api_key=qdrant_api_key,
+            )
             logger.info(f"Connected to Qdrant Cloud: {qdrant_url}")
         else:
             self.client = QdrantClient(":memory:")
+            # In-memory: client async sẽ là một storage riêng -> không dùng, fallback về client sync
+            self.aclient = None
             logger.warning("QDRANT_URL not set, using in-memory Qdrant")
         
-        try:
-            # Sử dụng all-MiniLM-L6-v2 như một giải pháp thay thế nhẹ cho CodeBERT
-            # trong môi trường resource-constrained, nhưng vẫn đảm bảo semantic search tốt.
-            from sentence_transformers import SentenceTransformer
-            self.model = SentenceTransformer('all-MiniLM-L6-v2')
-            self.vector_size = VECTOR_SIZE
-            logger.info("Loaded embedding model: all-MiniLM-L6-v2 (CodeBERT alternative)")
-        except Exception as e:
-            logger.error(f"Failed to load embedding model: {e}")
-            raise
+        # Hàng đợi point chờ bulk-upsert (chỉ dùng khi có aclient), tạo lazily trên event loop
+        self._upsert_queue: Optional[asyncio.Queue] = None
+        self._upsert_task: Optional[asyncio.Task] = None
+        # Số submission đang preprocess / encode, sắp đưa points vào hàng đợi
+        self._upsert_incoming = 0
+        
+        # source_id (hoặc point id với point cũ) -> [full_code, normalized full_code | None]
+        self._full_codes: "OrderedDict[str, list]" = OrderedDict()
+        # Ghi từ cả threadpool (get_suggestions / semantic_search) lẫn event loop (aget_suggestions)
+        self._full_codes_lock = threading.Lock()
+        self._encode_query_cached = lru_cache(maxsize=QUERY_CACHE_SIZE)(self._encode_query_uncached)
+        
+        # Embedding chạy trong 1 process riêng (spawn: không fork state của uvicorn/torch).
+        # Model load trong initializer của worker -> __init__ không còn block vài giây.
+        self.vector_size = VECTOR_SIZE
+        self._embed_pool = self._new_embed_pool()
+        # Worker chết (OOM kill...) làm hỏng cả pool: tạo lại dưới lock, 1 lần cho mọi caller đang lỗi
+        self._embed_pool_lock = threading.Lock()
+        logger.info(f"Embedding model {EMBEDDING_MODEL} (CodeBERT alternative) loading in worker process")
         
         self._init_collection()
     
+    @staticmethod
+    def _new_embed_pool() -> ProcessPoolExecutor:
+        pool = ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_load_embed_model,
+        )
+        # Khởi động worker ngay (không chờ) để model load song song với phần còn lại
+        pool.submit(_ping_embed_worker)
+        return pool
+    
+    def _replace_broken_embed_pool(self, broken: ProcessPoolExecutor):
+        """Thay pool hỏng bằng pool mới (blocking: spawn process) -> caller async gọi trong executor."""
+        with self._embed_pool_lock:
+            # Caller khác đã thay rồi
+            if self._embed_pool is not broken:
+                return
+            logger.warning("Embedding worker process died; restarting it")
+            broken.shutdown(wait=False, cancel_futures=True)
+            self._embed_pool = self._new_embed_pool()
+    
+    def _encode(self, texts: List[str]):
+        """Encode cả batch trong process embedding -> ma trận float32 [len(texts), VECTOR_SIZE] (đã normalize)."""
+        pool = self._embed_pool
+        try:
+            return pool.submit(_encode_batch, texts).result()
+        except BrokenProcessPool:
+            # Thử lại 1 lần với pool mới; hỏng tiếp thì để lỗi lên caller
+            self._replace_broken_embed_pool(pool)
+            return self._embed_pool.submit(_encode_batch, texts).result()
+    
+    async def _aencode(self, texts: List[str]):
+        """Bản async của _encode: await process embedding, không giữ thread của executor mặc định."""
+        loop = asyncio.get_running_loop()
+        pool = self._embed_pool
+        try:
+            return await loop.run_in_executor(pool, _encode_batch, texts)
+        except BrokenProcessPool:
+            await loop.run_in_executor(None, self._replace_broken_embed_pool, pool)
+            return await loop.run_in_executor(self._embed_pool, _encode_batch, texts)
+    
+    def _encode_query_uncached(self, code: str) -> Tuple[str, Tuple[float, ...]]:
+        normalized = normalize_code(code)
+        return normalized, tuple(self._encode([normalized])[0].tolist())
+    
+    def encode_query(self, code: str) -> Tuple[str, Tuple[float, ...]]:
+        """(normalize_code(code), embedding) của code truy vấn, cache LRU theo nội dung code."""
+        return self._encode_query_cached(code)
+    
+    @staticmethod
+    def _code_key(cand: RetrievedCode) -> str:
+        return cand.source_id or cand.id
+    
+    def _store_full_code_records(self, records):
+        with self._full_codes_lock:
+            for rec in records:
+                self._full_codes[str(rec.id)] = [(rec.payload or {}).get("full_code", ""), None]
+    
+    def _missing_full_code_ids(self, candidates: List[RetrievedCode]) -> Tuple[List[str], List[str]]:
+        """(source_id cần đọc từ collection meta, point id cũ cần đọc full_code từ chính point)."""
+        missing_sources = set()
+        missing_legacy = set()
+        with self._full_codes_lock:
+            for c in candidates:
+                if self._code_key(c) in self._full_codes:
+                    continue
+                if c.source_id:
+                    missing_sources.add(c.source_id)
+                else:
+                    missing_legacy.add(c.id)
+        return list(missing_sources), list(missing_legacy)
+    
+    def _apply_full_codes(self, candidates: List[RetrievedCode]):
+        with self._full_codes_lock:
+            while len(self._full_codes) > FULL_CODE_CACHE_SIZE:
+                self._full_codes.popitem(last=False)
+            for cand in candidates:
+                key = self._code_key(cand)
+                entry = self._full_codes.get(key)
+                if entry is not None:
+                    self._full_codes.move_to_end(key)
+                    cand.full_code = entry[0]
+    
+    def _retrieve_full_codes(self, collection_name: str, ids: List[str]):
+        if not ids:
+            return
+        try:
+            records = self.client.retrieve(
+                collection_name=collection_name,
+                ids=ids,
+                with_payload=["full_code"],
+                with_vectors=False,
+            )
+        except Exception as e:
+            logger.error(f"Retrieve full_code from {collection_name} failed: {e}")
+            return
+        self._store_full_code_records(records)
+    
+    async def _aretrieve_full_codes(self, collection_name: str, ids: List[str]):
+        if not ids:
+            return
+        try:
+            records = await self.aclient.retrieve(
+                collection_name=collection_name,
+                ids=ids,
+                with_payload=["full_code"],
+                with_vectors=False,
+            )
+        except Exception as e:
+            logger.error(f"Retrieve full_code from {collection_name} failed: {e}")
+            return
+        self._store_full_code_records(records)
+    
+    def _fill_full_code(self, candidates: List[RetrievedCode]):
+        """Điền full_code từ cache; phần thiếu được retrieve 1 request từ collection meta
+        (point cũ chưa có source_id thì đọc full_code trong payload của chính point đó)."""
+        missing_sources, missing_legacy = self._missing_full_code_ids(candidates)
+        self._retrieve_full_codes(self.COLLECTION_SUBMISSION_META, missing_sources)
+        self._retrieve_full_codes(self.COLLECTION_SUBMISSIONS, missing_legacy)
+        self._apply_full_codes(candidates)
+    
+    async def _afill_full_code(self, candidates: List[RetrievedCode]):
+        """Bản async của _fill_full_code (qua AsyncQdrantClient)."""
+        missing_sources, missing_legacy = self._missing_full_code_ids(candidates)
+        await asyncio.gather(
+            self._aretrieve_full_codes(self.COLLECTION_SUBMISSION_META, missing_sources),
+            self._aretrieve_full_codes(self.COLLECTION_SUBMISSIONS, missing_legacy),
+        )
+        self._apply_full_codes(candidates)
+    
+    def _normalized_target(self, cand: RetrievedCode) -> str:
+        """normalize_code(full_code) của candidate, cache cùng full_code theo submission."""
+        with self._full_codes_lock:
+            entry = self._full_codes.get(self._code_key(cand))
+            if entry is not None and entry[1] is not None:
+                return entry[1]
+        # So sánh với full_code của candidate (nếu có) hoặc chunk code; normalize ngoài lock
+        target_code = cand.full_code if cand.full_code else cand.code
+        normalized = normalize_code(target_code)
+        if entry is not None:
+            with self._full_codes_lock:
+                entry[1] = normalized
+        return normalized
+    
     def _init_collection(self):
         """Khởi tạo collection với các payload indexes cần thiết"""
         try:
@@ -86,21 +375,35 @@ class QdrantTutor:
                     collection_name=self.COLLECTION_SUBMISSIONS,
                     vectors_config=models.VectorParams(
                         size=self.vector_size,
-                        distance=models.Distance.COSINE
-                    )
+                        distance=models.Distance.COSINE,
+                        on_disk=True,
+                    ),
+                    quantization_config=QUANTIZATION_CONFIG,
                 )
                 logger.info(f"Created collection: {self.COLLECTION_SUBMISSIONS}")
+            else:
+                self._ensure_quantization()
+            
+            if self.COLLECTION_SUBMISSION_META not in existing:
+                # Chỉ lưu payload, truy cập theo id -> không cần vector
+                self.client.create_collection(
+                    collection_name=self.COLLECTION_SUBMISSION_META,
+                    vectors_config={},
+                    on_disk_payload=True,
+                )
+                logger.info(f"Created collection: {self.COLLECTION_SUBMISSION_META}")
             
             # Tạo indexes cho filtering
-            for field_name, field_type in [
-                ("problem_id", models.PayloadSchemaType.KEYWORD),
-                ("is_passed", models.PayloadSchemaType.BOOL),
-                ("user_uuid", models.PayloadSchemaType.KEYWORD),
-                ("algo_type", models.PayloadSchemaType.KEYWORD), # Support Clustering
+            for collection_name, field_name, field_type in [
+                (self.COLLECTION_SUBMISSIONS, "problem_id", models.PayloadSchemaType.KEYWORD),
+                (self.COLLECTION_SUBMISSIONS, "is_passed", models.PayloadSchemaType.BOOL),
+                (self.COLLECTION_SUBMISSIONS, "user_uuid", models.PayloadSchemaType.KEYWORD),
+                (self.COLLECTION_SUBMISSIONS, "algo_type", models.PayloadSchemaType.KEYWORD), # Support Clustering
+                (self.COLLECTION_SUBMISSION_META, "problem_id", models.PayloadSchemaType.KEYWORD),
             ]:
                 try:
                     self.client.create_payload_index(
-                        collection_name=self.COLLECTION_SUBMISSIONS,
+                        collection_name=collection_name,
                         field_name=field_name,
                         field_schema=field_type
                     )
@@ -111,40 +414,25 @@ class QdrantTutor:
             logger.error(f"Error initializing collection: {e}")
             raise
     
+    def _ensure_quantization(self):
+        """Bật scalar quantization cho collection cũ (tạo trước khi có cấu hình này)."""
+        try:
+            info = self.client.get_collection(self.COLLECTION_SUBMISSIONS)
+            if getattr(info.config, "quantization_config", None) is None:
+                self.client.update_collection(
+                    collection_name=self.COLLECTION_SUBMISSIONS,
+                    quantization_config=QUANTIZATION_CONFIG,
+                )
+                logger.info(f"Enabled INT8 quantization on {self.COLLECTION_SUBMISSIONS}")
+        except Exception as e:
+            logger.warning(f"Could not enable quantization: {e}")
+
     def _analyze_algo_type(self, code: str) -> str:
         """
         Phân loại thuật toán (Clustering Strategy Support).
         Dựa vào AST để phát hiện: Recursive vs Iterative.
         """
-        try:
-            tree = ast.parse(code)
-            is_recursive = False
-            has_loops = False
-            
-            # Tìm tên hàm (nếu có) để check đệ quy
-            func_names = set()
-            for node in ast.walk(tree):
-                if isinstance(node, ast.FunctionDef):
-                    func_names.add(node.name)
-            
-            for node in ast.walk(tree):
-                # Check Iterative
-                if isinstance(node, (ast.For, ast.While)):
-                    has_loops = True
-                
-                # Check Recursive
-                if isinstance(node, ast.Call):
-                    if isinstance(node.func, ast.Name) and node.func.id in func_names:
-                        is_recursive = True
-            
-            if is_recursive:
-                return "recursive"
-            if has_loops:
-                return "iterative"
-            return "sequential"
-            
-        except SyntaxError:
-            return "unknown"
+        return _detect_algo_type(code)
 
     def _chunk_code(self, code: str) -> List[str]:
         """
@@ -160,32 +448,30 @@ class QdrantTutor:
                 chunks.append(code[i:i + MAX_CHUNK_SIZE])
             return [c for c in chunks if c.strip()]
         
-        functions = []
-        for node in ast.walk(tree):
-            if isinstance(node, ast.FunctionDef):
-                func_code = ast.get_source_segment(code, node)
-                if func_code:
-                    functions.append(func_code.strip())
+        visitor = _FuncSpans()
+        visitor.visit(tree)
+        spans = visitor.spans
         
-        if functions:
-            for func_code in functions:
+        if spans:
+            lines = code.splitlines(keepends=True)
+            for start, end in spans:
+                func_code = "".join(lines[start:end]).strip()
+                if not func_code:
+                    continue
                 if len(func_code) <= MAX_CHUNK_SIZE:
                     chunks.append(func_code)
                 else:
-                    lines = func_code.split('\n')
-                    current_chunk = ''
-                    for line in lines:
-                        if len(current_chunk + '\n' + line) > MAX_CHUNK_SIZE:
-                            if current_chunk: chunks.append(current_chunk.strip())
-                            current_chunk = line
-                        else:
-                            current_chunk += '\n' + line if current_chunk else line
-                    if current_chunk: chunks.append(current_chunk.strip())
+                    chunks.extend(_split_lines(func_code))
             
-            remaining = code
-            for func in functions:
-                remaining = remaining.replace(func, '', 1)
-            remaining = remaining.strip()
+            # Phần code ngoài các hàm: lấy phần bù của các khoảng dòng [start, end)
+            remaining_parts = []
+            pos = 0
+            for start, end in sorted(spans):
+                if start > pos:
+                    remaining_parts.append("".join(lines[pos:start]))
+                pos = max(pos, end)
+            remaining_parts.append("".join(lines[pos:]))
+            remaining = "".join(remaining_parts).strip()
             if remaining:
                 chunks.append(remaining) # Simplify remaining handling
         else:
@@ -194,33 +480,48 @@ class QdrantTutor:
         
         return [c for c in chunks if c.strip()]
     
-    def add_submission(
-        self,
-        problem_id: str,
-        code_content: str,
-        is_passed: bool = False,
-        user_uuid: Optional[str] = None,
-        metadata: Optional[Dict[str, Any]] = None
-    ) -> List[str]:
-        """
-        Bước 3: Storage 
-        Lưu vector với metadata phong phú để hỗ trợ Clustering và Repair.
-        """
-        # 1. Preprocessing
+    def _preprocess_submission(self, code_content: str) -> Tuple[str, str, List[str]]:
+        """Preprocessing: (normalized_content, algo_type, chunks)."""
         normalized_content = normalize_code(code_content, remove_comments=True)
         algo_type = self._analyze_algo_type(normalized_content)
-
         chunks = self._chunk_code(normalized_content)
-        total_chunks = len(chunks)
+        return normalized_content, algo_type, chunks
+    
+    def _prepare_submission(self, code_content: str) -> Tuple[str, str, List[str], Any]:
+        """Preprocessing + Embedding: (normalized_content, algo_type, chunks, vectors)."""
+        normalized_content, algo_type, chunks = self._preprocess_submission(code_content)
+        # Embedding (1 lần forward cho toàn bộ chunks)
+        vectors = self._encode(chunks) if chunks else []
+        return normalized_content, algo_type, chunks, vectors
+    
+    def _build_points(
+        self,
+        problem_id: str,
+        normalized_content: str,
+        algo_type: str,
+        chunks: List[str],
+        vectors,
+        is_passed: bool,
+        user_uuid: Optional[str],
+        metadata: Optional[Dict[str, Any]]
+    ) -> Tuple[models.PointStruct, List[models.PointStruct]]:
+        """(bản ghi meta của submission, các chunk point). full_code chỉ lưu 1 lần ở bản ghi meta."""
+        source_id = str(uuid.uuid4())
+        meta_point = models.PointStruct(
+            id=source_id,
+            vector={},
+            payload={
+                "problem_id": str(problem_id),
+                "full_code": normalized_content,
+                "algo_type": algo_type,
+                "user_uuid": user_uuid or "anonymous",
+                **(metadata or {})
+            }
+        )
         
+        total_chunks = len(chunks)
         points = []
-        point_ids = []
-        
-        # 2. Embedding Loop
-        for i, chunk in enumerate(chunks):
-            point_id = str(uuid.uuid4())
-            vector = self.model.encode(chunk).tolist()
-            
+        for i, (chunk, vec) in enumerate(zip(chunks, vectors)):
             payload = {
                 "problem_id": str(problem_id),
                 "code": chunk,
@@ -228,25 +529,181 @@ class QdrantTutor:
                 "total_chunks": total_chunks,
                 "is_passed": is_passed,
                 "user_uuid": user_uuid or "anonymous",
-                "full_code": normalized_content,
+                "source_id": source_id,
                 "algo_type": algo_type, # Metadata for Clustering
                 **(metadata or {})
             }
             
             points.append(models.PointStruct(
-                id=point_id,
-                vector=vector,
+                id=str(uuid.uuid4()),
+                vector=vec.tolist(),
                 payload=payload
             ))
-            point_ids.append(point_id)
+        return meta_point, points
+    
+    def add_submission(
+        self,
+        problem_id: str,
+        code_content: str,
+        is_passed: bool = False,
+        user_uuid: Optional[str] = None,
+        metadata: Optional[Dict[str, Any]] = None
+    ) -> List[str]:
+        """
+        Bước 3: Storage 
+        Lưu vector với metadata phong phú để hỗ trợ Clustering và Repair.
+        """
+        normalized_content, algo_type, chunks, vectors = self._prepare_submission(code_content)
+        meta_point, points = self._build_points(
+            problem_id, normalized_content, algo_type, chunks, vectors, is_passed, user_uuid, metadata
+        )
+        if not points:
+            return []
         
+        self.client.upsert(
+            collection_name=self.COLLECTION_SUBMISSION_META,
+            points=[meta_point]
+        )
         self.client.upsert(
             collection_name=self.COLLECTION_SUBMISSIONS,
             points=points
         )
         
         logger.info(f"Added {len(points)} chunks for problem {problem_id} (passed={is_passed}, algo={algo_type})")
-        return point_ids
+        return [p.id for p in points]
+    
+    async def add_submission_async(
+        self,
+        problem_id: str,
+        code_content: str,
+        is_passed: bool = False,
+        user_uuid: Optional[str] = None,
+        metadata: Optional[Dict[str, Any]] = None
+    ) -> List[str]:
+        """
+        Bản async của add_submission cho caller chạy trên event loop.
+        Preprocessing chạy trong executor, encode await trực tiếp process embedding; points được đưa vào hàng đợi và flush theo lô
+        bởi _upsert_flusher (wait=False) -> trả về ids khi lô chứa submission đã upsert xong, point sẽ searchable sau vài trăm ms.
+        Upsert thất bại (hết số lần thử / shutdown) thì raise để caller không đánh dấu submission là đã chunk.
+        """
+        loop = asyncio.get_running_loop()
+        if self.aclient is None:
+            return await loop.run_in_executor(
+                None,
+                partial(self.add_submission, problem_id, code_content, is_passed, user_uuid, metadata),
+            )
+        
+        self._upsert_incoming += 1
+        try:
+            normalized_content, algo_type, chunks = await loop.run_in_executor(
+                None, self._preprocess_submission, code_content
+            )
+            vectors = await self._aencode(chunks) if chunks else []
+            meta_point, points = self._build_points(
+                problem_id, normalized_content, algo_type, chunks, vectors, is_passed, user_uuid, metadata
+            )
+            
+            if points:
+                self._ensure_upsert_flusher()
+                upserted = loop.create_future()
+                self._upsert_queue.put_nowait((meta_point, points, upserted))
+        finally:
+            self._upsert_incoming -= 1
+        
+        if points:
+            await upserted
+        
+        logger.info(f"Upserted {len(points)} chunks for problem {problem_id} (passed={is_passed}, algo={algo_type})")
+        return [p.id for p in points]
+    
+    def _ensure_upsert_flusher(self):
+        if self._upsert_queue is None:
+            self._upsert_queue = asyncio.Queue()
+        if self._upsert_task is None or self._upsert_task.done():
+            self._upsert_task = asyncio.create_task(self._upsert_flusher())
+    
+    async def _upsert_flusher(self):
+        """
+        Gom points trong hàng đợi thành lô rồi upsert: lấy hết những gì đã có sẵn, chỉ chờ thêm
+        (tối đa UPSERT_BATCH_MAX_DELAY) khi còn submission đang encode; lô đầy UPSERT_BATCH_MAX_POINTS thì flush ngay.
+        """
+        loop = asyncio.get_running_loop()
+        queue = self._upsert_queue
+        while True:
+            meta_point, points, upserted = await queue.get()
+            metas, batch, waiters = [meta_point], list(points), [upserted]
+            try:
+                deadline = loop.time() + UPSERT_BATCH_MAX_DELAY
+                while len(batch) < UPSERT_BATCH_MAX_POINTS:
+                    if queue.empty():
+                        timeout = deadline - loop.time()
+                        # Không còn gì sắp tới -> flush ngay, không ngồi chờ hết UPSERT_BATCH_MAX_DELAY
+                        if self._upsert_incoming == 0 or timeout <= 0:
+                            break
+                        try:
+                            meta_point, points, upserted = await asyncio.wait_for(queue.get(), timeout)
+                        except asyncio.TimeoutError:
+                            break
+                    else:
+                        meta_point, points, upserted = queue.get_nowait()
+                    metas.append(meta_point)
+                    batch.extend(points)
+                    waiters.append(upserted)
+                # Meta trước: chunk vừa searchable là đã có full_code để điền
+                await self._upsert_batch(self.COLLECTION_SUBMISSION_META, metas)
+                await self._upsert_batch(self.COLLECTION_SUBMISSIONS, batch)
+            except asyncio.CancelledError:
+                self._fail_waiters(waiters, RuntimeError("Upsert flusher stopped before the batch was written"))
+                raise
+            except Exception as e:
+                self._fail_waiters(waiters, e)
+            else:
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_result(None)
+            finally:
+                for _ in range(len(waiters)):
+                    queue.task_done()
+    
+    @staticmethod
+    def _fail_waiters(waiters, error: BaseException):
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_exception(error)
+    
+    async def _upsert_batch(self, collection_name: str, points: List[models.PointStruct]):
+        for attempt in range(1, UPSERT_MAX_ATTEMPTS + 1):
+            try:
+                # wait=False: Qdrant ack ngay, không chờ index xong (RAG chấp nhận trễ vài trăm ms)
+                await self.aclient.upsert(
+                    collection_name=collection_name,
+                    points=points,
+                    wait=False,
+                )
+                logger.info(f"Bulk upserted {len(points)} points to {collection_name}")
+                return
+            except Exception as e:
+                logger.warning(f"Bulk upsert attempt {attempt} to {collection_name} failed ({len(points)} points): {e}")
+                if attempt < UPSERT_MAX_ATTEMPTS:
+                    await asyncio.sleep(0.5 * attempt)
+        logger.error(f"Dropped {len(points)} points for {collection_name} after {UPSERT_MAX_ATTEMPTS} failed upserts")
+        raise RuntimeError(f"Upsert to {collection_name} failed after {UPSERT_MAX_ATTEMPTS} attempts")
+    
+    async def aclose(self, timeout: float = 10.0):
+        """Flush các point còn trong hàng đợi, đóng client async và process embedding (gọi khi shutdown)."""
+        if self._upsert_queue is not None and self._upsert_task is not None and not self._upsert_task.done():
+            try:
+                await asyncio.wait_for(self._upsert_queue.join(), timeout)
+            except asyncio.TimeoutError:
+                logger.error(f"Upsert queue not drained within {timeout}s; {self._upsert_queue.qsize()} batches pending")
+            self._upsert_task.cancel()
+            # Submission chưa kịp upsert: báo lỗi cho caller (không đánh dấu is_chunked, lần chunking sau làm lại)
+            while not self._upsert_queue.empty():
+                _, _, upserted = self._upsert_queue.get_nowait()
+                self._fail_waiters([upserted], RuntimeError("Qdrant client closed before the batch was written"))
+        if self.aclient is not None:
+            await self.aclient.close()
+        self._embed_pool.shutdown(wait=False, cancel_futures=True)
     
     def add_dataset(self, problem_id: str, code_content: str) -> List[str]:
         return self.add_submission(
@@ -256,21 +713,7 @@ class QdrantTutor:
             user_uuid="system_dataset"
         )
     
-    def get_suggestions(
-        self, 
-        student_code: str, 
-        problem_id: str, 
-        strategy: str = "rag",
-        top_k: int = 3
-    ) -> List[RetrievedCode]:
-        """
-        Lấy gợi ý code dựa trên chiến lược Unified hoặc Legacy.
-        Unified: Auto-Clustering + Edit Distance Re-ranking.
-        """
-        # Chuẩn hóa code input
-        query_vector = self.model.encode(normalize_code(student_code)).tolist()
-        
-        # 1. Build Filter
+    def _suggestion_filter(self, student_code: str, problem_id: str, strategy: str) -> models.Filter:
         must_conditions = [
             models.FieldCondition(
                 key="problem_id",
@@ -298,7 +741,76 @@ class QdrantTutor:
             except Exception:
                 pass # Fallback nếu lỗi parse
 
-        search_filter = models.Filter(must=must_conditions)
+        return models.Filter(must=must_conditions)
+
+    @staticmethod
+    def _hits_to_candidates(hits) -> List[RetrievedCode]:
+        candidates = []
+        for hit in hits:
+            candidates.append(RetrievedCode(
+                id=str(hit.id),
+                problem_id=hit.payload.get("problem_id", ""),
+                code=hit.payload.get("code", ""),
+                similarity=hit.score,
+                chunk_idx=hit.payload.get("chunk_idx", 0),
+                is_passed=hit.payload.get("is_passed", False),
+                user_uuid=hit.payload.get("user_uuid", ""),
+                total_chunks=hit.payload.get("total_chunks", 1),
+                algo_type=hit.payload.get("algo_type", "unknown"),
+                source_id=hit.payload.get("source_id", ""),
+                metadata={}
+            ))
+        return candidates
+
+    def _rerank(self, candidates: List[RetrievedCode], norm_student: str, strategy: str):
+        """Re-ranking (Levenshtein Distance) tại chỗ; candidates đã có full_code."""
+        try:
+            from rapidfuzz import process
+            from rapidfuzz.distance import Levenshtein
+            
+            # Khoảng cách chỉnh sửa tới mọi candidate trong 1 lần gọi (bit-parallel, chạy trong C).
+            # Không dùng score_cutoff: thứ tự sort cần khoảng cách đầy đủ của cả candidate xa.
+            norm_targets = [self._normalized_target(cand) for cand in candidates]
+            distances = process.cdist([norm_student], norm_targets, scorer=Levenshtein.distance)[0]
+            
+            for cand, dist in zip(candidates, distances):
+                # Tính điểm Normalized (càng gần 0 càng tốt -> similarity càng cao)
+                # Similarity gốc (Cosine) thường từ 0.7 - 1.0
+                # Ta muốn kết hợp: Score = w1 * Cosine - w2 * Dist
+                # Hoặc đơn giản: Ưu tiên Edit Distance cho Repair
+                
+                cand.metadata["edit_distance"] = int(dist)
+            
+            # Sort lại candidate
+            if strategy == "repair":
+                # Repair ưu tiên sửa ít nhất -> Sort by Distance ASC
+                candidates.sort(key=lambda x: x.metadata.get("edit_distance", 9999))
+            else: 
+                # Unified / RAG: Hybrid Score
+                # Hybrid = Sim - (Dist / 2000)
+                candidates.sort(key=lambda x: x.similarity - (x.metadata.get("edit_distance", 0) / 2000), reverse=True)
+
+        except ImportError:
+            logger.warning("rapidfuzz not installed, skipping re-ranking")
+
+    def get_suggestions(
+        self, 
+        student_code: str, 
+        problem_id: str, 
+        strategy: str = "rag",
+        top_k: int = 3,
+        raise_errors: bool = False
+    ) -> List[RetrievedCode]:
+        """
+        Lấy gợi ý code dựa trên chiến lược Unified hoặc Legacy.
+        Unified: Auto-Clustering + Edit Distance Re-ranking.
+        raise_errors=True: lỗi Qdrant được raise thay vì trả về [] (caller cần phân biệt "không có" với "lỗi").
+        """
+        # Chuẩn hóa code input (cache: cùng code không phải normalize + encode lại)
+        norm_student, query_vector = self.encode_query(student_code)
+        
+        # 1. Build Filter
+        search_filter = self._suggestion_filter(student_code, problem_id, strategy)
 
         # 2. Retrieval 
         # Nếu strategy="repair" hoặc "unified", ta lấy pool rộng hơn để re-rank
@@ -307,70 +819,80 @@ class QdrantTutor:
         try:
              results = self.client.query_points(
                 collection_name=self.COLLECTION_SUBMISSIONS,
-                query=query_vector,
+                query=list(query_vector),
                 query_filter=search_filter,
-                limit=pool_size
+                search_params=QUANTIZED_SEARCH_PARAMS,
+                limit=pool_size,
+                with_payload=models.PayloadSelectorInclude(include=SEARCH_PAYLOAD_FIELDS),
+                with_vectors=False,
              ).points
         except Exception as e:
              logging.error(f"Retrieve failed: {e}")
+             if raise_errors:
+                 raise
              return []
         
-        
         # Convert to RetrievedCode objects
-        candidates = []
-        for hit in results:
-            candidates.append(RetrievedCode(
-                id=str(hit.id),
-                problem_id=hit.payload.get("problem_id", ""),
-                code=hit.payload.get("code", ""),
-                similarity=hit.score,
-                chunk_idx=hit.payload.get("chunk_idx", 0),
-                is_passed=hit.payload.get("is_passed", False),
-                user_uuid=hit.payload.get("user_uuid", ""),
-                total_chunks=hit.payload.get("total_chunks", 1),
-                full_code=hit.payload.get("full_code", ""),
-                algo_type=hit.payload.get("algo_type", "unknown"),
-                metadata={}
-            ))
+        candidates = self._hits_to_candidates(results)
 
         # 3. Re-ranking (Levenshtein Distance)
         # Chỉ áp dụng re-ranking nếu có kết quả và strategy cần độ chính xác cao
-        if candidates and strategy in ["repair", "rag", "unified"]:
-            try:
-                import Levenshtein
-                
-                norm_student = normalize_code(student_code)
-                
-                for cand in candidates:
-                    # So sánh với full_code của candidate (nếu có) hoặc chunk code
-                    target_code = cand.full_code if cand.full_code else cand.code
-                    norm_target = normalize_code(target_code)
-                    
-                    # Tính khoảng cách chỉnh sửa
-                    dist = Levenshtein.distance(norm_student, norm_target)
-                    
-                    # Tính điểm Normalized (càng gần 0 càng tốt -> similarity càng cao)
-                    # Similarity gốc (Cosine) thường từ 0.7 - 1.0
-                    # Ta muốn kết hợp: Score = w1 * Cosine - w2 * Dist
-                    # Hoặc đơn giản: Ưu tiên Edit Distance cho Repair
-                    
-                    cand.metadata["edit_distance"] = dist
-                
-                # Sort lại candidate
-                if strategy == "repair":
-                    # Repair ưu tiên sửa ít nhất -> Sort by Distance ASC
-                    candidates.sort(key=lambda x: x.metadata.get("edit_distance", 9999))
-                else: 
-                    # Unified / RAG: Hybrid Score
-                    # Hybrid = Sim - (Dist / 2000)
-                    candidates.sort(key=lambda x: x.similarity - (x.metadata.get("edit_distance", 0) / 2000), reverse=True)
-
-            except ImportError:
-                logger.warning("python-Levenshtein not installed, skipping re-ranking")
+        rerank = bool(candidates) and strategy in ["repair", "rag", "unified"]
+        # Re-rank cần full_code của cả pool; không re-rank thì chỉ cần cho top_k trả về
+        self._fill_full_code(candidates if rerank else candidates[:top_k])
+        if rerank:
+            self._rerank(candidates, norm_student, strategy)
         
         # Trả về top_k tốt nhất
         return candidates[:top_k]
 
+    async def aget_suggestions(
+        self, 
+        student_code: str, 
+        problem_id: str, 
+        strategy: str = "rag",
+        top_k: int = 3,
+        raise_errors: bool = False
+    ) -> List[RetrievedCode]:
+        """
+        Bản async của get_suggestions: search / retrieve await qua AsyncQdrantClient,
+        không chiếm thread của threadpool trong lúc chờ network.
+        In-memory (không có aclient) thì chạy bản sync trong executor.
+        """
+        loop = asyncio.get_running_loop()
+        if self.aclient is None:
+            return await loop.run_in_executor(
+                None, partial(self.get_suggestions, student_code, problem_id, strategy, top_k, raise_errors)
+            )
+        
+        # Normalize + encode (CPU, cache LRU) ngoài event loop
+        norm_student, query_vector = await loop.run_in_executor(None, self.encode_query, student_code)
+        search_filter = self._suggestion_filter(student_code, problem_id, strategy)
+        pool_size = top_k * 3 if strategy in ["repair", "rag", "unified"] else top_k
+        
+        try:
+            response = await self.aclient.query_points(
+                collection_name=self.COLLECTION_SUBMISSIONS,
+                query=list(query_vector),
+                query_filter=search_filter,
+                search_params=QUANTIZED_SEARCH_PARAMS,
+                limit=pool_size,
+                with_payload=models.PayloadSelectorInclude(include=SEARCH_PAYLOAD_FIELDS),
+                with_vectors=False,
+            )
+        except Exception as e:
+            logging.error(f"Retrieve failed: {e}")
+            if raise_errors:
+                raise
+            return []
+        
+        candidates = self._hits_to_candidates(response.points)
+        rerank = bool(candidates) and strategy in ["repair", "rag", "unified"]
+        await self._afill_full_code(candidates if rerank else candidates[:top_k])
+        if rerank:
+            self._rerank(candidates, norm_student, strategy)
+        return candidates[:top_k]
+
     # ... keep other methods like get_collection_stats, delete_by_problem, etc if needed ...
     # Re-implementing simplified semantic_search to wrap get_suggestions
     def semantic_search(
@@ -381,8 +903,7 @@ class QdrantTutor:
         only_passed: bool = False
     ) -> List[RetrievedCode]:
         # Legacy support wrapper
-        processed = normalize_code(query)
-        vec = self.model.encode(processed).tolist()
+        _, vec = self.encode_query(query)
         conds = []
         if problem_id:
             conds.append(models.FieldCondition(key="problem_id", match=models.MatchValue(value=str(problem_id))))
@@ -391,17 +912,22 @@ class QdrantTutor:
         
         res = self.client.query_points(
             collection_name=self.COLLECTION_SUBMISSIONS,
-            query=vec,
+            query=list(vec),
             query_filter=models.Filter(must=conds) if conds else None,
-            limit=top_k
+            search_params=QUANTIZED_SEARCH_PARAMS,
+            limit=top_k,
+            with_payload=models.PayloadSelectorInclude(include=SEARCH_PAYLOAD_FIELDS),
+            with_vectors=False,
         ).points
-        return [
+        results = [
             RetrievedCode(
                 id=str(h.id), problem_id=h.payload.get("problem_id"), code=h.payload.get("code"),
                 similarity=h.score, chunk_idx=h.payload.get("chunk_idx"), is_passed=h.payload.get("is_passed"),
-                full_code=h.payload.get("full_code"), algo_type=h.payload.get("algo_type", "unknown")
+                algo_type=h.payload.get("algo_type", "unknown"), source_id=h.payload.get("source_id", "")
             ) for h in res
         ]
+        self._fill_full_code(results)
+        return results
 
     def get_collection_stats(self) -> Dict[str, Any]:
         """Lấy thống kê về collection"""
@@ -425,23 +951,33 @@ class QdrantTutor:
     
     def delete_by_problem(self, problem_id: str):
          try:
-            self.client.delete(
-                collection_name=self.COLLECTION_SUBMISSIONS,
-                points_selector=models.FilterSelector(
-                    filter=models.Filter(
-                        must=[models.FieldCondition(key="problem_id", match=models.MatchValue(value=problem_id))]
+            for collection_name in (self.COLLECTION_SUBMISSIONS, self.COLLECTION_SUBMISSION_META):
+                self.client.delete(
+                    collection_name=collection_name,
+                    points_selector=models.FilterSelector(
+                        filter=models.Filter(
+                            must=[models.FieldCondition(key="problem_id", match=models.MatchValue(value=problem_id))]
+                        )
                     )
                 )
-            )
             logger.info(f"Deleted all data for problem {problem_id}")
          except Exception as e:
             logger.error(f"Error deleting data: {e}")
 
 # Singleton instance
 _qdrant_tutor: Optional[QdrantTutor] = None
+_qdrant_tutor_lock = threading.Lock()
 
 def get_qdrant_tutor() -> QdrantTutor:
     global _qdrant_tutor
     if _qdrant_tutor is None:
-        _qdrant_tutor = QdrantTutor()
+        with _qdrant_tutor_lock:
+            if _qdrant_tutor is None:
+                _qdrant_tutor = QdrantTutor()
     return _qdrant_tutor
+
+
+async def shutdown_qdrant_tutor():
+    """Flush hàng đợi upsert và đóng kết nối nếu QdrantTutor đã được khởi tạo."""
+    if _qdrant_tutor is not None:
+        await _qdrant_tutor.aclose()
@@ -3,21 +3,120 @@ Hybrid Tutor - Hệ thống Gia sư AI sử dụng Qdrant RAG + AST Analysis.
 Kết hợp truy xuất code mẫu và phương pháp Socratic để hướng dẫn sinh viên.
 """
 
-from typing import Dict, List, Optional, Any
-from dataclasses import dataclass
+from typing import Dict, List, Optional, Any, Tuple
+from dataclasses import dataclass, replace
+from hashlib import blake2b
+import asyncio
+import difflib
 import logging
 import os
+import threading
 import time
-import json
+
+import numpy as np
+import orjson
+from cachetools import TTLCache
+
+from starlette.concurrency import run_in_threadpool
 
 from .qdrant_rag import get_qdrant_tutor
 from .analyzer import get_hybrid_analyzer, HybridAnalysisResult
-from infra.utils.normalize_code import normalize_code
-from infra.utils.llm_utils import get_groq_client
-import re
+from .feedback_cache import FeedbackCache
+from infra.utils.normalize_code import normalize_code_bundle
+from infra.utils.llm_utils import get_async_groq_client, extract_json_object
 
 logger = logging.getLogger(__name__)
 
+# Code mẫu dài hơn ngưỡng này thì chỉ gửi phần khác biệt (hoặc phần đầu) cho LLM
+REFERENCE_MAX_CHARS = 2000
+REFERENCE_HEAD_LINES = 40
+
+# Cache kết quả retrieval theo (problem_id, hash code đã normalize + đổi tên biến):
+# sinh viên nộp lại sau khi chỉ sửa khoảng trắng / comment -> bỏ qua Qdrant
+RETRIEVAL_CACHE_SIZE = 10_000
+RETRIEVAL_CACHE_TTL = 600
+
+# Unified System Prompt: hằng số module -> cùng 1 chuỗi (byte-identical) cho mọi request,
+# không dựng lại mỗi lần gọi và tận dụng được prompt/prefix cache phía provider.
+_SYSTEM_PROMPT_VI = (
+    "Trả lời bằng tiếng Việt.\n"
+    "Bạn là một Gia sư Python thông minh, sử dụng phương pháp Socratic kết hợp với code tham khảo từ hệ thống.\n\n"
+    "QUAN TRỌNG:\n"
+    "- KHÔNG cho đáp án trực tiếp hay viết code hoàn chỉnh thay sinh viên\n"
+    "- HÃY so sánh sự khác biệt giữa student_code và reference_code (code mẫu chuẩn) để tìm ra vấn đề\n"
+    "- Đặt câu hỏi dẫn dắt để sinh viên TỰ TÌM RA lỗi sai\n\n"
+    "Điều chỉnh mức độ gợi ý theo hint_level:\n"
+    "- Level 1-2: Hỏi về concept chung, không nhắc code mẫu\n"
+    "- Level 3-4: Gợi ý vị trí lỗi dựa trên sự khác biệt với code mẫu\n"
+    "- Level 5: Chỉ ra điểm sai cụ thể nhưng để sinh viên tự sửa\n\n"
+    "Trả về JSON hợp lệ: {\"hint\": \"...\", \"next_step\": \"...\"}"
+)
+
+_SYSTEM_PROMPT_EN = (
+    "Respond in English.\n"
+    "You are an intelligent Socratic Python Tutor utilizing reference code.\n\n"
+    "IMPORTANT:\n"
+    "- DO NOT give direct answers or write complete code\n"
+    "- COMPARE student_code with reference_code to identify gaps\n"
+    "- Ask guiding questions to help students DISCOVER the solution\n\n"
+    "Adjust hint levels:\n"
+    "- Level 1-2: General conceptual questions\n"
+    "- Level 3-4: Hint at error location based on differences\n"
+    "- Level 5: Point out specific discrepancy but let student fix it\n\n"
+    "Return valid JSON: {\"hint\": \"...\", \"next_step\": \"...\"}"
+)
+
+# Hint template khi không dùng LLM: dữ liệu ở hint_templates.json (sửa câu chữ không cần đụng code),
+# nạp 1 lần lúc import thành tuple lồng nhau [language][error_type][hint_level - 1],
+# tra bằng chỉ số, không cấp phát gì trên đường fallback.
+_LANGUAGE_INDEX = {"vi": 0, "en": 1}
+_ERROR_TYPE_INDEX = {"syntax": 0, "logic": 1, "runtime": 2, "infinite_loop": 3, "none": 4}
+_ERROR_TYPE_NONE = _ERROR_TYPE_INDEX["none"]
+
+HINT_TEMPLATES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "hint_templates.json")
+
+
+def _load_templates(path: str = HINT_TEMPLATES_PATH) -> Tuple[tuple, tuple]:
+    """(hint templates [lang][err][level-1], follow-up [lang][err]) từ file JSON."""
+    with open(path, "rb") as f:
+        data = orjson.loads(f.read())
+    langs = sorted(_LANGUAGE_INDEX, key=_LANGUAGE_INDEX.get)
+    errors = sorted(_ERROR_TYPE_INDEX, key=_ERROR_TYPE_INDEX.get)
+    hints = tuple(
+        tuple(tuple(data["hints"][lang][err]) for err in errors)
+        for lang in langs
+    )
+    follow_ups = tuple(
+        tuple(data["follow_ups"][lang][err] for err in errors)
+        for lang in langs
+    )
+    return hints, follow_ups
+
+
+_HINT_TEMPLATES, _FOLLOW_UPS = _load_templates()
+
+
+def _compact_reference(student_renamed: str, ref_code: Optional[str]) -> Tuple[Optional[str], str]:
+    """
+    Rút gọn reference_code cho prompt: (nội dung, định dạng).
+    Prompt chỉ cần sự khác biệt để so sánh -> unified diff giữa 2 bản đã đổi tên biến;
+    diff không ngắn hơn thì lấy REFERENCE_HEAD_LINES dòng đầu.
+    """
+    if not ref_code or len(ref_code) <= REFERENCE_MAX_CHARS:
+        return ref_code, "full"
+    ref_renamed = normalize_code_bundle(ref_code)[1]
+    diff = "\n".join(difflib.unified_diff(
+        student_renamed.splitlines(),
+        ref_renamed.splitlines(),
+        fromfile="student_code",
+        tofile="reference_code",
+        n=2,
+        lineterm="",
+    ))
+    if diff and len(diff) < len(ref_code):
+        return diff, "unified_diff"
+    return "\n".join(ref_code.splitlines()[:REFERENCE_HEAD_LINES]), "truncated"
+
 
 @dataclass
 class TutorFeedback:
@@ -54,6 +153,67 @@ class TutorFeedback:
             self.code_structure = {}
 
 
+@dataclass
+class TutorFeedbackBatch:
+    """
+    Phản hồi cho nhiều bài nộp, lưu theo cột (SoA): mỗi field là 1 mảng song song,
+    phần tử thứ i ứng với bài nộp thứ i. Cột số dùng numpy để thống kê / serialize 1 lần.
+    """
+    syntax_valid: np.ndarray          # bool[N]
+    error_type: List[str]
+    error_message: List[str]
+    error_line: List[Optional[int]]
+    reference_similarity: np.ndarray  # float32[N]
+    reference_used: np.ndarray        # bool[N]
+    hint: List[str]
+    hint_level: np.ndarray            # int8[N]
+    follow_up_question: List[str]
+    concepts_to_review: List[List[str]]
+    confidence: np.ndarray            # float32[N]
+    strategy: List[str]
+
+    @classmethod
+    def from_feedbacks(cls, feedbacks: List[TutorFeedback]) -> "TutorFeedbackBatch":
+        return cls(
+            syntax_valid=np.fromiter((f.syntax_valid for f in feedbacks), dtype=bool, count=len(feedbacks)),
+            error_type=[f.error_type for f in feedbacks],
+            error_message=[f.error_message for f in feedbacks],
+            error_line=[f.error_line for f in feedbacks],
+            reference_similarity=np.fromiter(
+                (f.reference_similarity for f in feedbacks), dtype=np.float32, count=len(feedbacks)
+            ),
+            reference_used=np.fromiter(
+                (f.reference_code is not None for f in feedbacks), dtype=bool, count=len(feedbacks)
+            ),
+            hint=[f.hint for f in feedbacks],
+            hint_level=np.fromiter((f.hint_level for f in feedbacks), dtype=np.int8, count=len(feedbacks)),
+            follow_up_question=[f.follow_up_question for f in feedbacks],
+            concepts_to_review=[f.concepts_to_review for f in feedbacks],
+            confidence=np.fromiter((f.confidence for f in feedbacks), dtype=np.float32, count=len(feedbacks)),
+            strategy=[f.strategy for f in feedbacks],
+        )
+
+    def __len__(self) -> int:
+        return len(self.hint)
+
+    def summary(self) -> Dict[str, Any]:
+        """Thống kê nhanh cho cả lớp: độ tin cậy trung bình, tỉ lệ đúng cú pháp, phân bố loại lỗi."""
+        error_types, counts = np.unique(np.asarray(self.error_type, dtype=object), return_counts=True)
+        return {
+            "count": len(self),
+            "mean_confidence": float(self.confidence.mean()) if len(self) else 0.0,
+            "syntax_valid_rate": float(self.syntax_valid.mean()) if len(self) else 0.0,
+            "error_types": {str(t): int(c) for t, c in zip(error_types, counts)},
+        }
+
+    def to_json(self) -> bytes:
+        """Serialize cả batch (các cột + summary) trong 1 lần gọi orjson."""
+        return orjson.dumps(
+            {**self.__dict__, "summary": self.summary()},
+            option=orjson.OPT_SERIALIZE_NUMPY,
+        )
+
+
 class HybridTutor:
     """
     Gia sư AI kết hợp RAG (Qdrant) và phương pháp Socratic.
@@ -70,12 +230,19 @@ class HybridTutor:
         self.qdrant = get_qdrant_tutor()
         self.analyzer = get_hybrid_analyzer()
         self._llm_client = None
+        # Cache phản hồi LLM cho bài nộp trùng / gần trùng (exact + semantic)
+        self.feedback_cache = FeedbackCache()
+        # Cache (ref_code, ref_similarity, algo_type) của lần retrieval trước cho cùng code
+        self._retrieval_cache: TTLCache = TTLCache(maxsize=RETRIEVAL_CACHE_SIZE, ttl=RETRIEVAL_CACHE_TTL)
+        self._retrieval_lock = threading.Lock()
+        # Tạo sẵn Groq client để request đầu tiên không phải chịu chi phí khởi tạo
+        self._get_llm_client()
     
     def _get_llm_client(self):
-        """Lazy load Groq client"""
+        """Lazy load Groq client (AsyncGroq)"""
         if self._llm_client is None:
             try:
-                self._llm_client = get_groq_client()
+                self._llm_client = get_async_groq_client()
             except Exception as e:
                 logger.error(f"Failed to initialize Groq client: {e}")
                 self._llm_client = None
@@ -98,42 +265,96 @@ class HybridTutor:
         previous_hints = previous_hints or []
 
         # 0. Empty Code Check
-        normalized_input = normalize_code(student_code)
+        # Kiểm tra thô trên chuỗi gốc trước: editor trống / chỉ có ký hiệu thì khỏi parse AST
+        stripped = student_code.strip()
+        if len(stripped) < 5 or not any(c.isalpha() for c in stripped):
+            return self._empty_code_feedback(hint_level)
+
+        # 1 lần parse cho cả bản normalize thường (kiểm tra rỗng) và bản đổi tên biến (cache key + LLM payload)
+        normalized_input, key_code = normalize_code_bundle(student_code)
         if not normalized_input or len(normalized_input.strip()) < 5:
-             # Code quá ngắn hoặc rỗng -> Trả về feedback nhắc nhở ngay
-             return TutorFeedback(
-                syntax_valid=False,
-                error_type="empty_code",
-                error_message="Bạn chưa viết code hoặc code quá ngắn.",
-                code_structure={},
-                reference_code=None,
-                reference_similarity=0.0,
-                hint="Hãy bắt đầu bằng việc đọc kỹ đề bài và viết thử vài dòng code nhé! Đừng ngại sai.",
-                hint_level=hint_level,
-                concepts_to_review=[],
-                confidence=1.0, # Tự tin là code rỗng
-                strategy="heuristic"
-            )
+            # Code quá ngắn hoặc rỗng (vd. chỉ có comment) -> Trả về feedback nhắc nhở ngay
+            return self._empty_code_feedback(hint_level)
 
+        retrieval_task = None
         try:
-            # 1. Phân tích (AST + Loguc)
-            analysis = self.analyzer.analyze_hybrid(student_code, run_sandbox=run_sandbox)
+            # Analysis và Retrieval độc lập nhau -> chạy song song.
+            # Embedding truy vấn tách riêng để cache feedback (1b) dùng chung, không encode 2 lần.
+            # Embedding chỉ tạo khi thật sự cần (retrieval miss cache hoặc tra semantic cache)
+            embed_task = None
 
-            # 2. Retrieval Unified Pipeline - Async Wrapper for Blocking Call
-            # Gọi Qdrant để lấy code mẫu tốt nhất (đã qua lọc Clustering và Re-rank bằng Edit Distance)
-            from starlette.concurrency import run_in_threadpool
-            
-            retrieved = await run_in_threadpool(
-                self.qdrant.get_suggestions,
-                student_code=student_code,
-                problem_id=problem_id,
-                strategy="unified", # Strategy unified: Cluster + Re-rank
-                top_k=1
-            )
+            def ensure_embed():
+                nonlocal embed_task
+                if embed_task is None:
+                    embed_task = asyncio.ensure_future(run_in_threadpool(self.qdrant.encode_query, student_code))
+                return embed_task
+
+            retrieval_key = (str(problem_id), blake2b(key_code.encode("utf-8"), digest_size=16).digest())
+            with self._retrieval_lock:
+                cached_reference = self._retrieval_cache.get(retrieval_key)
+
+            async def retrieve():
+                # 2. Retrieval Unified Pipeline
+                # Gọi Qdrant để lấy code mẫu tốt nhất (đã qua lọc Clustering và Re-rank bằng Edit Distance)
+                await ensure_embed()  # encode_query đã nằm trong cache LRU khi aget_suggestions gọi lại
+                return await self.qdrant.aget_suggestions(
+                    student_code=student_code,
+                    problem_id=problem_id,
+                    strategy="unified", # Strategy unified: Cluster + Re-rank
+                    top_k=1,
+                    raise_errors=True
+                )
+
+            if cached_reference is None:
+                retrieval_task = asyncio.ensure_future(retrieve())
+
+            # 1. Phân tích (AST + Loguc), trong threadpool khi retrieval đang chạy
+            analysis = await run_in_threadpool(self.analyzer.analyze_hybrid, student_code, run_sandbox=run_sandbox)
+
+            # 1b. Feedback cache: chỉ với code không lỗi và không chạy sandbox
+            # (lỗi / output runtime gắn với từng bài cụ thể, không dùng lại được)
+            # Đề bài + các hint đã đưa cũng nằm trong prompt -> phải thuộc key, nếu không sinh viên
+            # xin thêm hint cùng level sẽ nhận lại đúng hint cũ
+            context_digest = blake2b(
+                orjson.dumps([problem_description or "", previous_hints]), digest_size=16
+            ).digest()
+            cache_key = (str(problem_id), hint_level, language, context_digest)
+            use_cache = not run_sandbox and analysis.error_type == "none"
+            query_vector = None
+            if use_cache:
+                cached = self.feedback_cache.get_exact(cache_key, key_code)
+                if cached is None:
+                    _, query_vector = await ensure_embed()
+                    cached = self.feedback_cache.get_similar(cache_key, query_vector)
+                    strategy = "semantic_cache"
+                else:
+                    strategy = "exact_cache"
+                if cached is not None:
+                    return replace(
+                        cached,
+                        code_structure=analysis.code_structure,
+                        strategy=strategy,
+                    )
 
-            ref_code = retrieved[0].full_code if retrieved else None
-            ref_similarity = retrieved[0].similarity if retrieved else 0.0
-            algo_type = retrieved[0].algo_type if retrieved else "unknown"
+            if cached_reference is None:
+                try:
+                    retrieved = await retrieval_task
+                    retrieval_ok = True
+                except Exception as e:
+                    # Qdrant lỗi tạm thời: vẫn sinh hint (không có code mẫu) nhưng không cache kết quả rỗng
+                    logger.warning(f"Retrieval failed, continuing without reference: {e}")
+                    retrieved, retrieval_ok = [], False
+                cached_reference = (
+                    retrieved[0].full_code if retrieved else None,
+                    retrieved[0].similarity if retrieved else 0.0,
+                    retrieved[0].algo_type if retrieved else "unknown",
+                )
+                # Đọc full_code thất bại (lỗi đã được nuốt khi fill) cũng không cache
+                if retrieval_ok and (not retrieved or retrieved[0].full_code):
+                    with self._retrieval_lock:
+                        self._retrieval_cache[retrieval_key] = cached_reference
+
+            ref_code, ref_similarity, algo_type = cached_reference
             
             # Confidence logic
             confidence = self._calculate_confidence(analysis, ref_similarity)
@@ -150,7 +371,7 @@ class HybridTutor:
                     error_type=analysis.error_type,
                     error_message=analysis.error_message,
                     error_line=analysis.error_line,
-                    code_structure=self.analyzer.get_code_structure_summary(student_code),
+                    code_structure=analysis.code_structure,
                     reference_code=ref_code,
                     reference_similarity=ref_similarity,
                     hint=hint_text,
@@ -162,10 +383,13 @@ class HybridTutor:
                 )
 
             # Build JSON user payload theo spec (Unified)
+            # Code mẫu dài: gửi diff thay vì cả file (token prompt quyết định latency của Groq)
+            prompt_ref_code, ref_format = _compact_reference(key_code, ref_code)
             user_payload = {
-                "student_code": normalize_code(student_code, rename_vars=True),
+                "student_code": key_code,
                 "problem_statement": problem_description or "",
-                "reference_code": ref_code,
+                "reference_code": prompt_ref_code,
+                "reference_format": ref_format,
                 "reference_similarity": ref_similarity,
                 "reference_algo_type": algo_type, 
                 "error_type": analysis.error_type,
@@ -177,86 +401,57 @@ class HybridTutor:
             }
 
             # Tạo Unified System Prompt
-            if language == "vi":
-                system_prompt = (
-                    "Trả lời bằng tiếng Việt.\n"
-                    "Bạn là một Gia sư Python thông minh, sử dụng phương pháp Socratic kết hợp với code tham khảo từ hệ thống.\n\n"
-                    "QUAN TRỌNG:\n"
-                    "- KHÔNG cho đáp án trực tiếp hay viết code hoàn chỉnh thay sinh viên\n"
-                    "- HÃY so sánh sự khác biệt giữa student_code và reference_code (code mẫu chuẩn) để tìm ra vấn đề\n"
-                    "- Đặt câu hỏi dẫn dắt để sinh viên TỰ TÌM RA lỗi sai\n\n"
-                    "Điều chỉnh mức độ gợi ý theo hint_level:\n"
-                    "- Level 1-2: Hỏi về concept chung, không nhắc code mẫu\n"
-                    "- Level 3-4: Gợi ý vị trí lỗi dựa trên sự khác biệt với code mẫu\n"
-                    "- Level 5: Chỉ ra điểm sai cụ thể nhưng để sinh viên tự sửa\n\n"
-                    "Trả về JSON hợp lệ: {\"hint\": \"...\", \"next_step\": \"...\"}"
-                )
-            else:
-                system_prompt = (
-                    "Respond in English.\n"
-                    "You are an intelligent Socratic Python Tutor utilizing reference code.\n\n"
-                    "IMPORTANT:\n"
-                    "- DO NOT give direct answers or write complete code\n"
-                    "- COMPARE student_code with reference_code to identify gaps\n"
-                    "- Ask guiding questions to help students DISCOVER the solution\n\n"
-                    "Adjust hint levels:\n"
-                    "- Level 1-2: General conceptual questions\n"
-                    "- Level 3-4: Hint at error location based on differences\n"
-                    "- Level 5: Point out specific discrepancy but let student fix it\n\n"
-                    "Return valid JSON: {\"hint\": \"...\", \"next_step\": \"...\"}"
-                )
+            system_prompt = _SYSTEM_PROMPT_VI if language == "vi" else _SYSTEM_PROMPT_EN
             
-            # Logic gọi LLM (Async Wrapper)
+            # Logic gọi LLM (AsyncGroq: await trực tiếp, không qua threadpool)
+            llm_ok = False
             try:
-                def call_groq():
-                    return client.chat.completions.create(
-                        model=os.environ.get("GROQ_MODEL", "llama-3.1-8b-instant"),
-                        messages=[
-                            {"role": "system", "content": system_prompt},
-                            {"role": "user", "content": json.dumps(user_payload, ensure_ascii=False)}
-                        ],
-                        max_tokens=1024,
-                        temperature=0.0
-                    )
-                
-                response = await run_in_threadpool(call_groq)
+                response = await client.chat.completions.create(
+                    model=os.environ.get("GROQ_MODEL", "llama-3.1-8b-instant"),
+                    messages=[
+                        {"role": "system", "content": system_prompt},
+                        {"role": "user", "content": orjson.dumps(user_payload).decode()}
+                    ],
+                    max_tokens=1024,
+                    temperature=0.0,
+                    # JSON mode: model luôn trả về 1 object JSON hợp lệ
+                    response_format={"type": "json_object"}
+                )
                 
                 response_text = response.choices[0].message.content.strip()
 
-                # Parse JSON response
+                # Parse JSON response (JSON mode); nếu model vẫn bọc thêm text thì tách object
+                # bằng bộ quét ngoặc tuyến tính, cuối cùng mới dùng nguyên text làm hint
                 try:
-                    parsed = json.loads(response_text)
+                    try:
+                        parsed = orjson.loads(response_text)
+                    except orjson.JSONDecodeError:
+                        json_text = extract_json_object(response_text)
+                        if json_text is None:
+                            raise
+                        parsed = orjson.loads(json_text)
                     hint_text = parsed.get("hint", "").strip()
                     next_step = parsed.get("next_step", "").strip()
-                except json.JSONDecodeError:
-                    # Fallback parsing regex
-                    json_match = re.search(r'\{.*\}', response_text, re.DOTALL)
-                    if json_match:
-                        try:
-                            parsed = json.loads(json_match.group())
-                            hint_text = parsed.get("hint", "").strip()
-                            next_step = parsed.get("next_step", "").strip()
-                        except json.JSONDecodeError:
-                            hint_text = response_text.strip()
-                            next_step = ""
-                    else:
-                        hint_text = response_text.strip()
-                        next_step = ""
+                except (orjson.JSONDecodeError, AttributeError):
+                    hint_text = response_text.strip()
+                    next_step = ""
 
                 if not hint_text:
                     hint_text = self._generate_template_hint(analysis, hint_level, language)
+                else:
+                    llm_ok = True
 
             except Exception as e:
                 logger.error(f"LLM call failed: {e}")
                 hint_text = self._generate_template_hint(analysis, hint_level, language)
                 next_step = self._generate_follow_up(analysis, language)
 
-            return TutorFeedback(
+            feedback = TutorFeedback(
                 syntax_valid=analysis.ast_analysis.valid_syntax,
                 error_type=analysis.error_type,
                 error_message=analysis.error_message,
                 error_line=analysis.error_line,
-                code_structure=self.analyzer.get_code_structure_summary(student_code),
+                code_structure=analysis.code_structure,
                 reference_code=ref_code if ref_code else None,
                 reference_similarity=ref_similarity,
                 hint=hint_text,
@@ -266,6 +461,9 @@ class HybridTutor:
                 confidence=confidence,
                 strategy="unified_rag"
             )
+            if use_cache and query_vector is not None and llm_ok:
+                self.feedback_cache.put(cache_key, key_code, query_vector, feedback)
+            return feedback
             
             # Nếu không sử dụng LLM, sử dụng template hints
             hint_text = self._generate_template_hint(analysis, hint_level, language)
@@ -276,7 +474,7 @@ class HybridTutor:
                 error_type=analysis.error_type,
                 error_message=analysis.error_message,
                 error_line=analysis.error_line,
-                code_structure=self.analyzer.get_code_structure_summary(student_code),
+                code_structure=analysis.code_structure,
                 reference_code=ref_code,
                 reference_similarity=ref_similarity,
                 hint=hint_text,
@@ -290,7 +488,48 @@ class HybridTutor:
         except Exception as e:
             logger.exception("Error generating feedback")
             return self._generate_fallback_feedback(hint_level, language)
+        finally:
+            # Cache hit hoặc lỗi giữa chừng: không cần kết quả retrieval nữa
+            if retrieval_task is not None and not retrieval_task.done():
+                retrieval_task.cancel()
     
+    async def generate_feedback_batch(
+        self,
+        codes: List[str],
+        problem_id: str,
+        problem_description: str = "",
+        hint_level: int = 1,
+        language: str = "vi",
+        max_concurrency: int = 8
+    ) -> TutorFeedbackBatch:
+        """
+        Sinh phản hồi cho nhiều bài nộp của cùng 1 bài (vd. chấm cả lớp).
+        Mỗi bài chạy pipeline generate_feedback, song song tối đa max_concurrency bài;
+        bài trùng / gần trùng được feedback cache trả về ngay.
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def one(code: str) -> TutorFeedback:
+            async with semaphore:
+                return await self.generate_feedback(
+                    student_code=code,
+                    problem_id=problem_id,
+                    problem_description=problem_description,
+                    hint_level=hint_level,
+                    language=language,
+                )
+
+        feedbacks = await asyncio.gather(*(one(code) for code in codes))
+        batch = TutorFeedbackBatch.from_feedbacks(list(feedbacks))
+        # Độ tin cậy cả lớp tính 1 lần bằng numpy (cùng công thức _calculate_confidence);
+        # feedback heuristic (code rỗng) / fallback (lỗi pipeline) giữ giá trị cố định của chúng
+        scored = ~np.isin(np.asarray(batch.strategy, dtype=object), ("heuristic", "fallback"))
+        has_error = np.asarray(batch.error_type, dtype=object) != "none"
+        batch.confidence[scored] = self._calculate_confidence_batch(
+            batch.reference_similarity[scored], has_error[scored]
+        )
+        return batch
+
     def _build_socratic_prompt(
         self,
         student_code: str,
@@ -315,93 +554,9 @@ class HybridTutor:
         language: str
     ) -> str:
         """Sinh hint từ template khi không dùng LLM"""
-        
-        templates = {
-            "vi": {
-                "syntax": {
-                    1: "Có vẻ như có lỗi cú pháp trong code của bạn. Bạn đã kiểm tra lại cách viết chưa?",
-                    2: "Hãy kiểm tra lại các dấu ngoặc, dấu hai chấm và thụt lề trong code.",
-                    3: "Lỗi cú pháp thường xảy ra ở dấu ngoặc hoặc thụt lề. Xem lại dòng được báo lỗi.",
-                    4: "Kiểm tra dòng có lỗi: có đủ dấu ngoặc đóng không? Thụt lề có đúng không?",
-                    5: "Cú pháp Python yêu cầu: dấu hai chấm sau if/for/while/def, thụt lề 4 spaces."
-                },
-                "logic": {
-                    1: "Kết quả có vẻ chưa đúng. Bạn đã thử với các trường hợp khác nhau chưa?",
-                    2: "Hãy nghĩ về logic của thuật toán. Các điều kiện đã đầy đủ chưa?",
-                    3: "Kiểm tra lại các điều kiện trong vòng lặp và câu lệnh if.",
-                    4: "Chú ý đến giá trị biên. Vòng lặp bắt đầu và kết thúc đúng chỗ chưa?",
-                    5: "Kiểm tra range(): range(n) cho 0 đến n-1, range(1, n+1) cho 1 đến n."
-                },
-                "runtime": {
-                    1: "Code gặp lỗi khi chạy. Bạn đã kiểm tra các biến chưa?",
-                    2: "Có biến nào đang được sử dụng mà chưa được tạo không?",
-                    3: "Kiểm tra tên biến: có viết đúng không? Có tạo trước khi dùng không?",
-                    4: "Lỗi NameError thường do biến chưa được gán giá trị hoặc viết sai tên.",
-                    5: "Thêm dòng khởi tạo biến trước khi sử dụng."
-                },
-                "infinite_loop": {
-                    1: "Code có vẻ chạy mãi. Vòng lặp của bạn có điểm dừng không?",
-                    2: "Vòng lặp while cần có điều kiện dừng. Bạn đã kiểm tra chưa?",
-                    3: "Biến điều kiện có được thay đổi trong vòng lặp không?",
-                    4: "Với while True, cần có break hoặc return để thoát.",
-                    5: "Thêm điều kiện if và break để thoát vòng lặp khi cần."
-                },
-                "none": {
-                    1: "Code của bạn có vẻ OK. Hãy thử với nhiều test case hơn.",
-                    2: "Kiểm tra lại logic với các trường hợp đặc biệt.",
-                    3: "Xem xét các edge cases: list rỗng, số âm, số 0...",
-                    4: "So sánh output với kết quả mong đợi.",
-                    5: "Nếu bạn vẫn cần giúp, hãy mô tả vấn đề cụ thể hơn."
-                }
-            },
-            "en": {
-                "syntax": {
-                    1: "There seems to be a syntax error. Have you checked your code structure?",
-                    2: "Check your brackets, colons, and indentation.",
-                    3: "Syntax errors often occur with brackets or indentation. Review the error line.",
-                    4: "Check the error line: are brackets balanced? Is indentation correct?",
-                    5: "Python syntax requires: colon after if/for/while/def, 4-space indentation."
-                },
-                "logic": {
-                    1: "The result doesn't seem right. Have you tried different test cases?",
-                    2: "Think about the algorithm logic. Are all conditions covered?",
-                    3: "Review conditions in your loops and if statements.",
-                    4: "Pay attention to boundary values. Does the loop start/end correctly?",
-                    5: "Check range(): range(n) gives 0 to n-1, range(1, n+1) gives 1 to n."
-                },
-                "runtime": {
-                    1: "The code encounters an error when running. Have you checked your variables?",
-                    2: "Is there a variable being used before it's defined?",
-                    3: "Check variable names: spelled correctly? Defined before use?",
-                    4: "NameError usually means a variable wasn't assigned or is misspelled.",
-                    5: "Add a line to initialize the variable before using it."
-                },
-                "infinite_loop": {
-                    1: "The code seems to run forever. Does your loop have a stopping point?",
-                    2: "While loops need a stopping condition. Have you checked?",
-                    3: "Is the condition variable being modified inside the loop?",
-                    4: "With while True, you need break or return to exit.",
-                    5: "Add an if condition with break to exit the loop when needed."
-                },
-                "none": {
-                    1: "Your code looks OK. Try testing with more test cases.",
-                    2: "Review the logic with special cases.",
-                    3: "Consider edge cases: empty list, negative numbers, zero...",
-                    4: "Compare output with expected results.",
-                    5: "If you still need help, describe your issue more specifically."
-                }
-            }
-        }
-        
-        lang_templates = templates.get(language, templates["vi"])
-        
-        error_type = "none"
-        if analysis:
-            error_type = analysis.error_type or "none"
-        
-        type_templates = lang_templates.get(error_type, lang_templates["none"])
-        
-        return type_templates.get(hint_level, type_templates[1])
+        lang_i = _LANGUAGE_INDEX.get(language, 0)
+        err_i = _ERROR_TYPE_INDEX.get(analysis.error_type, _ERROR_TYPE_NONE) if analysis else _ERROR_TYPE_NONE
+        return _HINT_TEMPLATES[lang_i][err_i][min(max(hint_level, 1), 5) - 1]
     
     def _generate_follow_up(
         self,
@@ -409,28 +564,8 @@ class HybridTutor:
         language: str
     ) -> str:
         """Tạo câu hỏi follow-up"""
-        if language == "vi":
-            if analysis.error_type == "syntax":
-                return "Bạn có thể chỉ ra dòng nào có lỗi không?"
-            elif analysis.error_type == "logic":
-                return "Kết quả bạn mong đợi là gì? Kết quả thực tế là gì?"
-            elif analysis.error_type == "runtime":
-                return "Lỗi xảy ra ở dòng nào? Thông báo lỗi nói gì?"
-            elif analysis.error_type == "infinite_loop":
-                return "Điều kiện dừng của vòng lặp là gì?"
-            else:
-                return "Bạn có câu hỏi gì thêm không?"
-        else:
-            if analysis.error_type == "syntax":
-                return "Can you identify which line has the error?"
-            elif analysis.error_type == "logic":
-                return "What output do you expect? What do you actually get?"
-            elif analysis.error_type == "runtime":
-                return "Which line causes the error? What does the error message say?"
-            elif analysis.error_type == "infinite_loop":
-                return "What is the stopping condition for your loop?"
-            else:
-                return "Do you have any other questions?"
+        lang_i = 0 if language == "vi" else 1
+        return _FOLLOW_UPS[lang_i][_ERROR_TYPE_INDEX.get(analysis.error_type, _ERROR_TYPE_NONE)]
     
     def _calculate_confidence(
         self,
@@ -473,7 +608,32 @@ class HybridTutor:
 
         return min(0.98, confidence)
 
-    
+    @staticmethod
+    def _calculate_confidence_batch(similarities: np.ndarray, has_error: np.ndarray) -> np.ndarray:
+        """
+        Bản vector hoá của _calculate_confidence cho N bài nộp (cùng công thức):
+        min(0.98, 0.7*max(0, sim) + (0.3 nếu có lỗi, ngược lại 0.1)).
+        """
+        similarities = np.maximum(np.asarray(similarities, dtype=np.float64), 0.0)
+        return np.minimum(0.98, similarities * 0.7 + np.where(np.asarray(has_error, dtype=bool), 0.3, 0.1))
+
+    @staticmethod
+    def _empty_code_feedback(hint_level: int) -> TutorFeedback:
+        """Feedback nhắc nhở khi code rỗng hoặc quá ngắn."""
+        return TutorFeedback(
+            syntax_valid=False,
+            error_type="empty_code",
+            error_message="Bạn chưa viết code hoặc code quá ngắn.",
+            code_structure={},
+            reference_code=None,
+            reference_similarity=0.0,
+            hint="Hãy bắt đầu bằng việc đọc kỹ đề bài và viết thử vài dòng code nhé! Đừng ngại sai.",
+            hint_level=hint_level,
+            concepts_to_review=[],
+            confidence=1.0, # Tự tin là code rỗng
+            strategy="heuristic"
+        )
+
     def _generate_fallback_feedback(
         self,
         hint_level: int,
@@ -495,6 +655,12 @@ class HybridTutor:
             strategy="fallback"
         )
     
+    def _invalidate_retrieval(self, problem_id: str) -> None:
+        """Xoá kết quả retrieval đã cache của 1 bài."""
+        with self._retrieval_lock:
+            for key in [k for k in self._retrieval_cache.keys() if k[0] == problem_id]:
+                self._retrieval_cache.pop(key, None)
+
     def add_to_knowledge_base(
         self,
         problem_id: str,
@@ -505,6 +671,9 @@ class HybridTutor:
         """
         Thêm code vào knowledge base.
         """
+        # Code mẫu mới có thể đổi reference tốt nhất -> bỏ feedback đã cache của bài này
+        self.feedback_cache.invalidate_problem(str(problem_id))
+        self._invalidate_retrieval(str(problem_id))
         if is_passed and user_uuid:
             self.qdrant.add_submission(
                 problem_id=problem_id, 
@@ -518,11 +687,14 @@ class HybridTutor:
 
 # Singleton instance
 _hybrid_tutor: Optional[HybridTutor] = None
+_hybrid_tutor_lock = threading.Lock()
 
 
 def get_hybrid_tutor() -> HybridTutor:
-    """Lấy instance của HybridTutor"""
+    """Lấy instance của HybridTutor (double-checked locking: warm-up và request đầu có thể gọi đồng thời)"""
     global _hybrid_tutor
     if _hybrid_tutor is None:
-        _hybrid_tutor = HybridTutor()
+        with _hybrid_tutor_lock:
+            if _hybrid_tutor is None:
+                _hybrid_tutor = HybridTutor()
     return _hybrid_tutor
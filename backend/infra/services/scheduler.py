@@ -10,6 +10,7 @@ Tính năng:
 
 import asyncio
 import logging
+from collections import deque
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Any
 from dataclasses import dataclass, field
@@ -21,6 +22,9 @@ from domain.models import Submission, QdrantSchedule
 
 logger = logging.getLogger(__name__)
 
+# Số submission được đẩy vào Qdrant đồng thời khi chunking (encode chồng lên upsert).
+CHUNK_PIPELINE_WINDOW = 4
+
 
 class ScheduleStatus(str, Enum):
     PENDING = "pending"
@@ -257,7 +261,7 @@ class QdrantScheduler:
         
         try:
             loop = asyncio.get_running_loop()
-            result = await loop.run_in_executor(None, self._chunk_submissions_sync, schedule_db)
+            result = await loop.run_in_executor(None, self._chunk_submissions_sync, schedule_db, loop)
             
             schedule_db.submissions_processed = result["submissions_processed"]
             schedule_db.points_created = result["points_created"]
@@ -284,8 +288,12 @@ class QdrantScheduler:
                 self.schedules[schedule_db.id].status = ScheduleStatus.FAILED
                 self.schedules[schedule_db.id].completed_at = schedule_db.completed_at
     
-    def _chunk_submissions_sync(self, schedule: QdrantSchedule) -> Dict[str, int]:
-        """Thực hiện chunking các submission"""
+    def _chunk_submissions_sync(self, schedule: QdrantSchedule, loop: asyncio.AbstractEventLoop) -> Dict[str, int]:
+        """Thực hiện chunking các submission.
+
+        Chạy trong executor (DB sync); việc lưu Qdrant được đẩy lên event loop qua
+        add_submission_async theo cửa sổ CHUNK_PIPELINE_WINDOW submission.
+        """
         db = SessionLocal()
         try:
             from domain.ai import get_qdrant_tutor
@@ -309,19 +317,14 @@ class QdrantScheduler:
             
             submissions_processed = 0
             points_created = 0
+            in_flight = deque()
             
-            for submission in submissions:
+            def _finish_oldest():
+                nonlocal submissions_processed, points_created
+                submission, future = in_flight.popleft()
                 try:
-                    point_ids = qdrant.add_submission(
-                        problem_id=str(submission.problem_id),
-                        code_content=submission.code,
-                        is_passed=submission.passed_all,
-                        user_uuid=str(submission.user_id),
-                        metadata={
-                            "submission_id": submission.id,
-                            "submitted_at": submission.submitted_at.isoformat() if getattr(submission, 'submitted_at', None) else None
-                        }
-                    )
+                    # Chỉ xong khi lô chứa submission đã upsert thành công; lỗi -> giữ is_chunked=False để lần sau làm lại
+                    point_ids = future.result()
                     submissions_processed += 1
                     points_created += len(point_ids)
                     
@@ -330,7 +333,27 @@ class QdrantScheduler:
                     
                 except Exception as e:
                     logger.error(f"Failed to chunk submission {submission.id}: {e}")
-                    continue
+            
+            for submission in submissions:
+                future = asyncio.run_coroutine_threadsafe(
+                    qdrant.add_submission_async(
+                        problem_id=str(submission.problem_id),
+                        code_content=submission.code,
+                        is_passed=submission.passed_all,
+                        user_uuid=str(submission.user_id),
+                        metadata={
+                            "submission_id": submission.id,
+                            "submitted_at": submission.submitted_at.isoformat() if getattr(submission, 'submitted_at', None) else None
+                        }
+                    ),
+                    loop,
+                )
+                in_flight.append((submission, future))
+                if len(in_flight) >= CHUNK_PIPELINE_WINDOW:
+                    _finish_oldest()
+            
+            while in_flight:
+                _finish_oldest()
             
             return {
                 "submissions_processed": submissions_processed,
@@ -5,9 +5,10 @@ import os
 from functools import lru_cache
 
 try:
-    from groq import Groq
+    from groq import Groq, AsyncGroq
 except Exception:
     Groq = None
+    AsyncGroq = None
 
 logger = logging.getLogger(__name__)
 
@@ -46,6 +47,25 @@ def get_groq_client():
     return init_groq_client()
 
 
+def init_async_groq_client(api_key: str | None = None):
+    if AsyncGroq is None:
+        raise RuntimeError("groq package is not installed. Install with `pip install groq`")
+    key = api_key or os.environ.get("GROQ_API_KEY")
+    if not key:
+        raise ValueError("GROQ_API_KEY not set in environment and no api_key provided")
+    return AsyncGroq(api_key=key)
+
+
+@lru_cache(maxsize=1)
+def get_async_groq_client():
+    """Singleton AsyncGroq client (per-process) cho các đường gọi từ event loop.
+
+    Ghi chú (vi):
+    - Request LLM được await trên event loop, không chiếm thread của threadpool khi chờ network.
+    """
+    return init_async_groq_client()
+
+
 def create_groq_completion(client, messages, model: str = "openai/gpt-oss-20b", stream: bool = False, **kwargs):
     params = {"model": model, "messages": messages, "stream": stream}
     params.update(kwargs or {})
@@ -86,3 +106,35 @@ def extract_groq_content(response) -> str:
         return choice.get("text", str(response))
     except Exception:
         return str(response)
+
+
+def extract_json_object(text: str) -> str | None:
+    """Trả về object JSON {...} cân bằng ngoài cùng đầu tiên trong text (vd. khi model bọc JSON trong markdown).
+
+    Quét 1 lượt với stack vị trí "{", bỏ qua ngoặc nằm trong string -> tuyến tính, không backtracking
+    như regex r'\{.*\}' với DOTALL. Nếu "{" ngoài cùng không bao giờ đóng, lấy object cân bằng
+    bắt đầu sớm nhất bên trong.
+    """
+    opens = []
+    best = None
+    in_string = False
+    escaped = False
+    for i, ch in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = opens != []
+        elif ch == "{":
+            opens.append(i)
+        elif ch == "}" and opens:
+            start = opens.pop()
+            if not opens:
+                return text[start:i + 1]
+            if best is None or start < best[0]:
+                best = (start, i + 1)
+    return text[best[0]:best[1]] if best else None
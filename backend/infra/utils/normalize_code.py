@@ -1,10 +1,22 @@
 import ast
+import io
+import tokenize
+from functools import lru_cache
+from typing import Optional, Tuple
 
 class VariableRenamer(ast.NodeTransformer):
     """
     AST Transformer để đổi tên biến về dạng chuẩn (var1, var2...)
     Giúp model embedding tập trung vào cấu trúc logic thay vì tên biến.
     """
+    # Tên builtin / self giữ nguyên (hằng của class, không dựng set mới mỗi lần visit)
+    _BUILTINS = frozenset({
+        'self', 'print', 'range', 'len', 'int', 'str', 'float', 'input',
+        'True', 'False', 'None', 'list', 'dict', 'tuple', 'set', 'map', 'filter',
+        'abs', 'min', 'max', 'sum', 'enumerate', 'zip', 'sorted', 'reversed',
+        'type', 'isinstance',
+    })
+
     def __init__(self):
         self.var_map = {}
         self.arg_map = {}
@@ -12,8 +24,9 @@ class VariableRenamer(ast.NodeTransformer):
         self.arg_counter = 1
 
     def visit_FunctionDef(self, node):
-        # Reset scope cho local vars mỗi function, nhưng giữ args map
-        old_var_map = self.var_map.copy()
+        # Reset scope cho local vars mỗi function, nhưng giữ args map.
+        # var_map chỉ thêm key mới (không ghi đè) -> nhớ số key hiện có thay vì copy cả dict
+        outer_size = len(self.var_map)
         
         # Rename arguments
         if node.args.args:
@@ -25,14 +38,16 @@ class VariableRenamer(ast.NodeTransformer):
                 arg.arg = self.arg_map[arg.arg]
         
         self.generic_visit(node)
-        self.var_map = old_var_map # Restore scope
+        # Restore scope: dict giữ thứ tự chèn, popitem() bỏ đúng các biến local vừa thêm
+        while len(self.var_map) > outer_size:
+            self.var_map.popitem()
         return node
 
     def visit_Name(self, node):
         # Chỉ rename biến thông thường (Store/Load), không rename builtin/function calls
         if isinstance(node.ctx, (ast.Store, ast.Load)):
             # Bỏ qua nếu là tên hàm builtin hoặc self
-            if node.id in {'self', 'print', 'range', 'len', 'int', 'str', 'float', 'input'}:
+            if node.id in self._BUILTINS:
                 return node
                 
             if node.id not in self.var_map:
@@ -48,6 +63,76 @@ class VariableRenamer(ast.NodeTransformer):
                 node.id = self.var_map[node.id]
         return node
 
+def _parse_once(code: str) -> Optional[ast.Module]:
+    """Parse code 1 lần; None nếu lỗi syntax (code sinh viên thường lỗi)."""
+    try:
+        return ast.parse(code)
+    except Exception:
+        return None
+
+
+# Chỉ các scope này có docstring (body[0]); các field còn lại chứa list statement lồng nhau
+_DOCSTRING_SCOPES = (ast.Module, ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+_STMT_LIST_FIELDS = ('body', 'orelse', 'finalbody', 'handlers', 'cases')
+
+
+def _strip_docstrings(node: ast.AST) -> ast.AST:
+    """Loại bỏ docstrings (in-place); chỉ duyệt các list statement, không đi vào biểu thức."""
+    body = getattr(node, 'body', None)
+    if isinstance(node, _DOCSTRING_SCOPES) and body and isinstance(body[0], ast.Expr):
+        value = body[0].value
+        # ast.Str đã deprecated (bỏ ở 3.12): docstring là Constant kiểu str
+        if isinstance(value, ast.Constant) and isinstance(value.value, str):
+            if len(body) == 1:
+                body[0] = ast.Pass()
+            else:
+                body.pop(0)
+
+    for field_name in _STMT_LIST_FIELDS:
+        children = getattr(node, field_name, None)
+        if not isinstance(children, list):
+            continue
+        for child in children:
+            if isinstance(child, (ast.stmt, ast.excepthandler, ast.match_case)):
+                _strip_docstrings(child)
+    return node
+
+
+def _rename_vars(tree: ast.Module) -> ast.Module:
+    """Chuẩn hóa tên biến (Alpha Renaming) -> var1, var2... (in-place)."""
+    return VariableRenamer().visit(tree)
+
+
+def _unparsed(tree: ast.AST) -> str:
+    """
+    Code sinh từ AST: không còn comment -> không cần tách '#', nhưng vẫn bỏ dòng trống
+    (unparse chèn trước def/class lồng nhau) để output giống hệt các chunk đã lưu.
+    """
+    lines = [line.rstrip() for line in ast.unparse(tree).splitlines() if line.strip()]
+    return "\n".join(lines).strip() + "\n"
+
+
+def _strip_comments(code: str) -> str:
+    """Bỏ comment # bằng tokenize (giữ nguyên '#' trong string literal)."""
+    try:
+        tokens = [
+            tok for tok in tokenize.generate_tokens(io.StringIO(code).readline)
+            if tok.type != tokenize.COMMENT
+        ]
+        return tokenize.untokenize(tokens)
+    except (tokenize.TokenError, SyntaxError):
+        # Không tokenize được (vd. ngoặc / string chưa đóng): cắt theo dòng
+        return "\n".join(line.split('#', 1)[0] for line in code.splitlines())
+
+
+def _finalize(code: str, remove_comments: bool = True) -> str:
+    """Cho code không parse được: bỏ comment (nếu enable), dòng trống và khoảng trắng cuối dòng."""
+    if remove_comments:
+        code = _strip_comments(code)
+    lines = [line.rstrip() for line in code.splitlines() if line.strip()]
+    return "\n".join(lines).strip() + "\n"
+
+
 def normalize_code(code: str, remove_comments: bool = True, rename_vars: bool = False) -> str:
     """
     Chuẩn hoá code cho quy trình Preprocessing.
@@ -59,48 +144,53 @@ def normalize_code(code: str, remove_comments: bool = True, rename_vars: bool =
     """
     if not code:
         return ""
+    return _normalize_cached(code, remove_comments, rename_vars)
 
-    # Bước 1 & 2: Dùng AST
+
+@lru_cache(maxsize=2048)
+def _normalize_cached(code: str, remove_comments: bool, rename_vars: bool) -> str:
+    """Hàm thuần của normalize_code, cache theo (code, options): cùng code được chuẩn hoá ở nhiều nơi (ingest, retrieval, admin)."""
+    # Bước 1 & 2: Dùng AST; unparse thành công thì output đã sạch comment
     if remove_comments or rename_vars:
-        try:
-            parsed = ast.parse(code)
-            
-            # 1. Remove Docstrings
-            if remove_comments:
-                for node in ast.walk(parsed):
-                    if not isinstance(node, (ast.FunctionDef, ast.ClassDef, ast.AsyncFunctionDef, ast.Module)):
-                        continue
-                    if not (node.body and isinstance(node.body[0], ast.Expr)):
-                        continue
-                    if hasattr(node.body[0], 'value') and isinstance(node.body[0].value, ast.Str):
-                        if len(node.body) == 1:
-                            node.body[0] = ast.Pass()
-                        else:
-                            node.body.pop(0)
-
-            # 2. Rename Variables (Alpha Renaming)
-            if rename_vars:
-                renamer = VariableRenamer()
-                parsed = renamer.visit(parsed)
-
-            if hasattr(ast, 'unparse'):
-                code = ast.unparse(parsed)
-                
-        except Exception:
-            # Fallback nếu lỗi syntax (code sinh viên thường lỗi)
-            pass
+        parsed = _parse_once(code)
+        if parsed is not None:
+            try:
+                if remove_comments:
+                    _strip_docstrings(parsed)
+                if rename_vars:
+                    parsed = _rename_vars(parsed)
+                return _unparsed(parsed)
+            except Exception:
+                pass
 
-    # Bước 3: Regex cleaning cho comments # (nếu unparse không chạy hoặc không sạch hết)
-    if remove_comments:
-        lines = []
-        for line in code.splitlines():
-            if '#' in line:
-                line = line.split('#', 1)[0]
-            if line.strip():
-                lines.append(line.rstrip())
-        normalized = "\n".join(lines)
-    else:
-        lines = [line.rstrip() for line in code.splitlines() if line.strip()]
-        normalized = "\n".join(lines)
-
-    return normalized.strip() + "\n"
\ No newline at end of file
+    # Bước 3: code lỗi syntax -> bỏ comment bằng tokenize + chuẩn hóa dòng
+    return _finalize(code, remove_comments)
+
+
+@lru_cache(maxsize=512)
+def normalize_code_bundle(code: str) -> Tuple[str, str]:
+    """
+    (normalize_code(code), normalize_code(code, rename_vars=True)) với 1 lần parse.
+    Bỏ docstring -> unparse lấy bản thường, rồi đổi tên biến trên cùng cây -> unparse lần 2.
+    Cache theo nội dung code: cùng code được gửi lại khi retry / tăng hint level.
+    """
+    if not code:
+        return "", ""
+
+    parsed = _parse_once(code)
+    if parsed is None:
+        plain = _finalize(code)
+        return plain, plain
+
+    try:
+        _strip_docstrings(parsed)
+        plain = _unparsed(parsed)
+    except Exception:
+        plain = _finalize(code)
+        return plain, plain
+
+    try:
+        renamed = _unparsed(_rename_vars(parsed))
+    except Exception:
+        renamed = _finalize(code)
+    return plain, renamed
@@ -1,22 +1,29 @@
 import os
-import sys
 import pty
-import select
-import subprocess
 import fcntl
-import termios
 import asyncio
 import signal
 import json
-import tempfile
 import logging
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import multiprocessing
-import io
-import contextlib
+from multiprocessing import forkserver
+from multiprocessing.connection import Connection
 import traceback
+import marshal
+from functools import lru_cache
+from typing import NamedTuple
+from collections import deque
+
+import sandbox_child
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
@@ -41,89 +48,441 @@ class ExecutionResult(BaseModel):
     stderr: str
     success: bool
     error: str = ""
+    truncated: bool = False
+
+# Code /run được compile ở tiến trình chính và gửi code object (marshal) cho worker;
+# bài nộp lại y hệt (bấm Run nhiều lần) lấy luôn từ cache, không compile lại.
+COMPILE_CACHE_SIZE = 256
+
+
+@lru_cache(maxsize=COMPILE_CACHE_SIZE)
+def _compile_marshal(code: str) -> bytes:
+    return marshal.dumps(compile(code, "<string>", "exec", dont_inherit=True))
+
+
+def _child_parent_pid():
+    """
+    pid cha thật của tiến trình con = forkserver (nó thoát theo service khi service chết).
+    Blocking nếu forkserver chưa chạy -> chỉ gọi trong executor.
+    """
+    forkserver.ensure_running()
+    return forkserver._forkserver._forkserver_pid
 
-def execute_code_worker(code, stdin_input, result_queue):
-    stdout_capture = io.StringIO()
-    stderr_capture = io.StringIO()
-    if stdin_input:
-        stdin_input = stdin_input.replace("\\n", "\n")
-    stdin_capture = io.StringIO(stdin_input)
-    success = False
-    error_msg = None
+
+async def _wait_readable(fd):
+    """Chờ fd sẵn sàng đọc bằng add_reader của event loop (không poll, không thread)."""
+    loop = asyncio.get_running_loop()
+    ready = loop.create_future()
+    loop.add_reader(fd, lambda: ready.done() or ready.set_result(None))
     try:
-        with contextlib.redirect_stdout(stdout_capture), contextlib.redirect_stderr(stderr_capture):
-            sys.stdin = stdin_capture
-            global_scope = {
-                "__builtins__": __builtins__,
-                "print": print, "input": input, "range": range, "len": len,
-            }
-            exec(code, global_scope)
-            success = True
-    except Exception:
-        error_msg = traceback.format_exc()
-        success = False
-        stderr_capture.write(error_msg)
+        await ready
     finally:
-        result_queue.put({
-            "stdout": stdout_capture.getvalue(),
-            "stderr": stderr_capture.getvalue(),
-            "success": success,
-            "error": error_msg
-        })
+        loop.remove_reader(fd)
+
+
+async def _wait_process_exit(p):
+    """Chờ sentinel của tiến trình sẵn sàng đọc (= đã thoát) ngay trên event loop, không poll."""
+    await _wait_readable(p.sentinel)
+
+
+async def _kill_and_reap(p):
+    """
+    SIGKILL (code sinh viên không bắt / bỏ qua được như SIGTERM) cả process group của p
+    (thread / tiến trình con mà code sinh viên bỏ lại), rồi reap khi sentinel báo, không chặn event loop.
+    """
+    try:
+        # Tiến trình con đã setsid -> pgid == pid; chưa kịp setsid thì chưa có group này -> kill riêng p
+        os.killpg(p.pid, signal.SIGKILL)
+    except OSError:
+        p.kill()
+    await _wait_process_exit(p)
+    p.join()
+
+
+# Worker /run và tiến trình terminal fork từ forkserver; forkserver chỉ import sẵn sandbox_child (stdlib)
+# + vài module hay dùng, không import app.py -> code sinh viên không thấy state của service.
+# Tiến trình con chỉ nhận các fd được truyền tường minh (không thừa kế pty / pipe của phiên khác như fork() thẳng).
+# Chạy service bằng `python -m uvicorn` (Dockerfile): __main__ là uvicorn.__main__ nên tiến trình con
+# không chạy lại script của __main__ mỗi lần fork.
+_child_ctx = multiprocessing.get_context("forkserver")
+_child_ctx.set_forkserver_preload(["sandbox_child", "math", "random"])
+
+# Worker /run khởi động sẵn: fork nằm ngoài critical path của request.
+# Mỗi worker chỉ chạy đúng 1 bài rồi thoát -> code của user này không để lại state cho user khác.
+RUN_POOL_SIZE = int(os.getenv("RUN_POOL_SIZE", str(os.cpu_count() or 2)))
+RUN_TIMEOUT_SECONDS = 5
+
+
+class _PoolWorker(NamedTuple):
+    process: multiprocessing.Process
+    job_conn: Connection      # parent -> worker (chỉ ghi)
+    result_conn: Connection   # worker -> parent (chỉ đọc)
+
+    def close(self):
+        self.job_conn.close()
+        self.result_conn.close()
+
+
+class _WarmWorkerPool:
+    """Hàng đợi các worker đã fork sẵn, đang chờ job."""
+
+    def __init__(self, size: int):
+        self._size = max(1, size)
+        self._idle = asyncio.Queue()
+        self._refills = set()
+        self._closed = False
+
+    @staticmethod
+    def _spawn() -> _PoolWorker:
+        """Tạo 1 worker (round-trip tới forkserver, blocking) -> gọi trong executor."""
+        # 2 pipe 1 chiều (duplex=False): mỗi chiều chỉ 1 message, không cần socketpair / Queue + feeder thread
+        job_reader, job_writer = multiprocessing.Pipe(duplex=False)
+        result_reader, result_writer = multiprocessing.Pipe(duplex=False)
+        process = _child_ctx.Process(
+            target=sandbox_child.pool_worker, args=(_child_parent_pid(), job_reader, result_writer)
+        )
+        process.start()
+        job_reader.close()
+        result_writer.close()
+        return _PoolWorker(process, job_writer, result_reader)
+
+    async def _spawn_async(self) -> _PoolWorker:
+        return await asyncio.get_running_loop().run_in_executor(None, self._spawn)
+
+    async def _refill(self):
+        try:
+            worker = await self._spawn_async()
+        except Exception as e:
+            logger.error(f"Failed to start /run worker: {e}")
+            return
+        if self._closed:
+            worker.close()
+            worker.process.kill()
+            return
+        self._idle.put_nowait(worker)
+
+    async def start(self):
+        await asyncio.gather(*(self._refill() for _ in range(self._size)))
+
+    async def acquire(self) -> _PoolWorker:
+        """Lấy 1 worker rảnh và tạo worker thay thế ở nền (executor), không chặn event loop."""
+        worker = await self._idle.get()
+        refill = asyncio.ensure_future(self._refill())
+        self._refills.add(refill)
+        refill.add_done_callback(self._refills.discard)
+        if not worker.process.is_alive():
+            # Worker chết khi đang chờ (vd. bị OOM kill) -> dùng worker mới
+            worker.close()
+            return await self._spawn_async()
+        return worker
+
+    def shutdown(self):
+        self._closed = True
+        while not self._idle.empty():
+            worker = self._idle.get_nowait()
+            worker.close()
+            worker.process.terminate()
+
+
+_run_pool = _WarmWorkerPool(RUN_POOL_SIZE)
+
+
+@app.on_event("startup")
+async def _start_run_pool():
+    await _run_pool.start()
+
+
+@app.on_event("shutdown")
+async def _stop_run_pool():
+    _run_pool.shutdown()
+
 
 @app.post("/run", response_model=ExecutionResult)
 async def run_code(request: CodeRequest):
-    queue = multiprocessing.Queue()
-    process = multiprocessing.Process(target=execute_code_worker, args=(request.code, request.stdin, queue))
-    process.start()
-    process.join(5)
-    if process.is_alive():
-        process.terminate()
-        process.join()
-        return ExecutionResult(stdout="", stderr="Time Limit Exceeded", success=False, error="Timeout")
-    if not queue.empty():
-        result = queue.get()
-        return ExecutionResult(stdout=result["stdout"], stderr=result["stderr"], success=result["success"], error=str(result["error"] or ""))
-    return ExecutionResult(stdout="", stderr="Crash", success=False, error="Crash")
+    try:
+        code_bytes = _compile_marshal(request.code)
+    except (SyntaxError, ValueError, RecursionError, MemoryError) as e:
+        # Lỗi cú pháp (hoặc code quá lồng nhau / có null byte): trả về ngay, không tốn worker
+        error_msg = "".join(traceback.format_exception_only(type(e), e))
+        return ExecutionResult(stdout="", stderr=error_msg, success=False, error=error_msg)
+
+    worker = await _run_pool.acquire()
+    process = worker.process
+    loop = asyncio.get_running_loop()
+    try:
+        # send / recv trên pipe là lời gọi blocking (message lớn hơn buffer pipe) -> chạy trong executor
+        await loop.run_in_executor(None, worker.job_conn.send, (code_bytes, request.stdin))
+        try:
+            # Event loop báo ngay khi worker gửi kết quả (hoặc chết -> EOF), không chiếm thread chờ poll
+            await asyncio.wait_for(_wait_readable(worker.result_conn.fileno()), RUN_TIMEOUT_SECONDS)
+            result = await asyncio.wait_for(
+                loop.run_in_executor(None, worker.result_conn.recv), RUN_TIMEOUT_SECONDS
+            )
+        except asyncio.TimeoutError:
+            return ExecutionResult(stdout="", stderr="Time Limit Exceeded", success=False, error="Timeout")
+        return ExecutionResult(stdout=result["stdout"], stderr=result["stderr"], success=result["success"], error=str(result["error"] or ""),
+                               truncated=result["truncated"])
+    except (EOFError, OSError):
+        # Worker chết trước khi gửi kết quả
+        return ExecutionResult(stdout="", stderr="Crash", success=False, error="Crash")
+    finally:
+        # Đã có kết quả nhưng thread non-daemon / tiến trình con của code sinh viên có thể vẫn chạy:
+        # worker chỉ dùng 1 lần nên luôn kill + reap cả group (trước khi đóng pipe mà executor có thể còn dùng)
+        await _kill_and_reap(process)
+        worker.close()
 
 
 # WEBSOCKET TERMINAL
 
-async def _forward_output(fd, websocket: WebSocket):
-    """Đọc từ pty master fd và gửi qua websocket"""
-    loop = asyncio.get_event_loop()
-    max_read_bytes = 1024
+# Gom output pty thành 1 websocket frame: tối đa OUTPUT_BATCH_MAX_BYTES,
+# hoặc những gì đến trong OUTPUT_BATCH_MAX_DELAY giây kể từ chunk đầu tiên.
+# Giới hạn cứng để 1 chương trình in liên tục không làm batch phình vô hạn.
+OUTPUT_BATCH_MAX_BYTES = 256 * 1024
+OUTPUT_BATCH_MAX_DELAY = 0.005
+# Mỗi lần os.read lấy tối đa 64 KB (cỡ buffer pty của Linux), đọc đến EAGAIN
+PTY_READ_BYTES = 64 * 1024
+# Sau khi tiến trình thoát, chờ tối đa chừng này để gửi nốt output còn trong pty
+EXIT_OUTPUT_GRACE_SECONDS = 1.0
+
 
-    while True:
+def _set_nonblocking(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+
+def _drain_fd(fd, view: memoryview, offset: int):
+    """
+    Đọc fd (non-blocking) thẳng vào view[offset:] bằng readv đến khi hết dữ liệu hoặc đầy.
+    Trả về (offset mới, EOF hay chưa).
+    """
+    limit = len(view)
+    while offset < limit:
         try:
-            # Chờ đến khi có dữ liệu từ fd
-            r, _, _ = await loop.run_in_executor(None, lambda: select.select([fd], [], [], 1.0))
-            if not r:
-                await asyncio.sleep(0)
-                continue
-
-            data = await loop.run_in_executor(None, os.read, fd, max_read_bytes)
-            if not data:
-                raise Exception("EOF")
-            await websocket.send_text(data.decode('utf-8', errors='replace'))
+            n = os.readv(fd, [view[offset:offset + PTY_READ_BYTES]])
+        except BlockingIOError:
+            return offset, False
         except OSError:
-            break
-        except asyncio.CancelledError:
-            break
-        except Exception as e:
-            logger.error(f"Error reading from pty: {e}")
-            break
-
-async def _monitor_process(p, websocket: WebSocket):
-    """Theo dõi tiến trình và đóng websocket khi tiến trình kết thúc"""
-    while True:
-        await asyncio.sleep(0.5)
-        if p.poll() is not None:
-            try:
-                await websocket.close()
-            except Exception:
-                pass
-            break
+            # EIO: phía slave đã đóng (tiến trình con thoát)
+            return offset, True
+        if n == 0:
+            return offset, True
+        offset += n
+    return offset, False
+
+
+class _PtyOutput:
+    """
+    Đọc pty master bằng loop.add_reader (epoll của chính event loop, không tốn thread executor).
+    Callback đọc ngay vào buffer cấp sẵn của phiên; coroutine gửi lấy ra theo từng batch.
+    """
+
+    def __init__(self, loop, fd):
+        self._loop = loop
+        self._fd = fd
+        # 1 buffer cho cả phiên: readv ghi thẳng vào, chỉ copy 1 lần khi gửi
+        self._buf = bytearray(OUTPUT_BATCH_MAX_BYTES)
+        self._view = memoryview(self._buf)
+        self._size = 0
+        self._ready = asyncio.Event()
+        self._reading = False
+        self._sentinel = None
+        self._exit_deadline = None
+        self.eof = False
+        _set_nonblocking(fd)
+        self._resume()
+
+    def _resume(self):
+        if not self._reading and not self.eof:
+            self._loop.add_reader(self._fd, self._on_readable)
+            self._reading = True
+
+    def _pause(self):
+        if self._reading:
+            self._loop.remove_reader(self._fd)
+            self._reading = False
+
+    def _on_readable(self):
+        self._size, self.eof = _drain_fd(self._fd, self._view, self._size)
+        # Buffer đầy (websocket gửi chậm) hoặc EOF -> ngừng đọc cho đến khi batch được lấy đi
+        if self.eof or self._size >= OUTPUT_BATCH_MAX_BYTES:
+            self._pause()
+        self._ready.set()
+
+    def watch_exit(self, sentinel):
+        """Theo dõi sentinel của tiến trình ngay trên event loop, không cần task riêng chờ tiến trình thoát."""
+        self._sentinel = sentinel
+        self._loop.add_reader(sentinel, self._on_exit)
+
+    def _on_exit(self):
+        self._loop.remove_reader(self._sentinel)
+        self._sentinel = None
+        # Tiến trình con của chương trình có thể còn giữ slave -> không chờ EOF mãi
+        self._exit_deadline = self._loop.time() + EXIT_OUTPUT_GRACE_SECONDS
+        self._ready.set()
+
+    async def next_batch(self):
+        """Batch output tiếp theo (bytes); None khi đã EOF (hoặc tiến trình đã thoát quá hạn chờ) và không còn dữ liệu."""
+        while True:
+            if not self._size and self.eof:
+                return None
+            if self._exit_deadline is None:
+                await self._ready.wait()
+            else:
+                try:
+                    await asyncio.wait_for(self._ready.wait(), max(0.0, self._exit_deadline - self._loop.time()))
+                except asyncio.TimeoutError:
+                    if not self._size:
+                        return None
+            if not self.eof and self._size < OUTPUT_BATCH_MAX_BYTES:
+                # Output tương tác thường đến thành nhiều mảnh nhỏ: chờ thêm 1 cửa sổ ngắn rồi gửi 1 lần
+                await asyncio.sleep(OUTPUT_BATCH_MAX_DELAY)
+            self._ready.clear()
+            data = bytes(self._view[:self._size]) if self._size else None
+            self._size = 0
+            self._resume()
+            if data:
+                return data
+
+    def close(self):
+        self._pause()
+        if self._sentinel is not None:
+            self._loop.remove_reader(self._sentinel)
+            self._sentinel = None
+
+
+async def _write_all(fd, data: bytes):
+    """Ghi hết data vào fd non-blocking; pty đầy (chương trình chưa đọc input) thì chờ add_writer, không chặn event loop."""
+    loop = asyncio.get_running_loop()
+    view = memoryview(data)
+    while view:
+        try:
+            view = view[os.write(fd, view):]
+            continue
+        except BlockingIOError:
+            pass
+        writable = loop.create_future()
+        loop.add_writer(fd, lambda: writable.done() or writable.set_result(None))
+        try:
+            await writable
+        finally:
+            loop.remove_writer(fd)
+
+
+async def _forward_output(output: _PtyOutput, websocket: WebSocket):
+    """
+    Task duy nhất của phiên: gửi output pty qua websocket (gom nhiều chunk nhỏ thành 1 frame bytes),
+    hết output (EOF / tiến trình đã thoát) thì đóng websocket.
+    """
+    try:
+        while True:
+            data = await output.next_batch()
+            if data is None:
+                break
+            # Gửi bytes thô: client (xterm) tự decode UTF-8, không decode/encode lại ở đây
+            await websocket.send_bytes(data)
+    except asyncio.CancelledError:
+        return
+    except OSError:
+        pass
+    except Exception as e:
+        logger.error(f"Error reading from pty: {e}")
+    try:
+        await websocket.close()
+    except Exception:
+        pass
+
+def _start_pty_process_sync(slave_fd, code):
+    p = _child_ctx.Process(
+        target=sandbox_child.pty_child, args=(_child_parent_pid(), sandbox_child.PassFd(slave_fd), code)
+    )
+    p.start()
+    return p
+
+
+async def _start_pty_process(slave_fd, code):
+    """start() là 1 round-trip (blocking) tới forkserver -> chạy trong executor, không chặn event loop."""
+    return await asyncio.get_running_loop().run_in_executor(None, _start_pty_process_sync, slave_fd, code)
+
+
+@app.on_event("startup")
+async def _start_pty_forkserver():
+    # Khởi động forkserver ngay từ đầu để phiên terminal đầu tiên không phải chờ import
+    await asyncio.get_running_loop().run_in_executor(None, forkserver.ensure_running)
+
+
+# Số cặp pty mở sẵn; pty đã dùng không tái sử dụng (tiến trình sót lại của phiên cũ có thể vẫn giữ slave)
+PTY_POOL_SIZE = 16
+
+
+class _PtyPool:
+    """Các cặp (master_fd, slave_fd) mở sẵn; mỗi phiên lấy 1 cặp mới rồi tự đóng khi xong."""
+
+    def __init__(self, size: int):
+        self._size = max(1, size)
+        self._idle = deque()
+
+    def _refill(self):
+        while len(self._idle) < self._size:
+            self._idle.append(pty.openpty())
+
+    def start(self):
+        self._refill()
+
+    def acquire(self):
+        """Lấy 1 cặp pty (hết thì openpty trực tiếp), bù lại pool sau request hiện tại."""
+        pair = self._idle.popleft() if self._idle else pty.openpty()
+        asyncio.get_running_loop().call_soon(self._refill)
+        return pair
+
+    def shutdown(self):
+        while self._idle:
+            for fd in self._idle.popleft():
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+
+
+_pty_pool = _PtyPool(PTY_POOL_SIZE)
+
+
+@app.on_event("startup")
+async def _start_pty_pool():
+    _pty_pool.start()
+
+
+@app.on_event("shutdown")
+async def _stop_pty_pool():
+    _pty_pool.shutdown()
+
+
+async def _terminate(p, timeout: float):
+    """
+    Dừng tiến trình terminal: SIGTERM cả process group (shell có thể sinh tiến trình con),
+    quá timeout thì SIGKILL; reap qua sentinel, không chặn event loop.
+    """
+    if not p.is_alive():
+        return
+    try:
+        # Tiến trình con đã setsid -> pgid == pid
+        os.killpg(p.pid, signal.SIGTERM)
+    except OSError:
+        p.terminate()
+    try:
+        await asyncio.wait_for(_wait_process_exit(p), timeout)
+        p.join()
+    except asyncio.TimeoutError:
+        await _kill_and_reap(p)
+
+
+async def _receive_payload(websocket: WebSocket) -> bytes:
+    """Nhận 1 message (text hoặc binary) dạng bytes UTF-8; binary frame đi thẳng vào pty không qua decode."""
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000))
+    if message.get("bytes") is not None:
+        return message["bytes"]
+    return (message.get("text") or "").encode("utf-8")
+
 
 @app.websocket("/terminal")
 async def terminal_endpoint(websocket: WebSocket):
@@ -131,124 +490,86 @@ async def terminal_endpoint(websocket: WebSocket):
 
     master_fd = None
     slave_fd = None
+    pty_output = None
     output_task = None
-    monitor_task = None
     p = None
-    code_file = None
 
     try:
-        first_msg = await websocket.receive_text()
+        first_msg = await _receive_payload(websocket)
         start_obj = None
         try:
-            parsed = json.loads(first_msg)
+            parsed = _json_loads(first_msg)
             if isinstance(parsed, dict) and parsed.get("type") == "start" and "code" in parsed:
                 start_obj = parsed
         except Exception:
             start_obj = None
 
-        # Tạo pseudo-terminal (pty)
-        master_fd, slave_fd = pty.openpty()
+        # Lấy pseudo-terminal (pty) mở sẵn từ pool
+        master_fd, slave_fd = _pty_pool.acquire()
 
         # Giữ TTY echo enabled để người dùng có thể thấy những gì đã nhập
         # Không thay đổi ECHO
 
-        def _preexec_with_ctty():
-            os.setsid()
-            try:
-                fcntl.ioctl(slave_fd, termios.TIOCSCTTY, 0)
-            except Exception:
-                pass
-
         if start_obj is not None:
             # Run python trực tiếp với code được cung cấp
             code = start_obj.get("code", "")
             stdin_seed = start_obj.get("stdin", "")
 
-            with tempfile.NamedTemporaryFile(mode="w", suffix=".py", delete=False, encoding="utf-8") as f:
-                f.write(code)
-                code_file = f.name
-
-            p = subprocess.Popen(
-                ["python3", "-u", code_file],
-                preexec_fn=_preexec_with_ctty,
-                stdin=slave_fd,
-                stdout=slave_fd,
-                stderr=slave_fd,
-                universal_newlines=True,
-            )
+            p = await _start_pty_process(slave_fd, code)
 
+            # Tiến trình con đã nhận bản dup của slave khi start()
             os.close(slave_fd)
             slave_fd = None
 
-            output_task = asyncio.create_task(_forward_output(master_fd, websocket))
-            monitor_task = asyncio.create_task(_monitor_process(p, websocket))
+            pty_output = _PtyOutput(asyncio.get_running_loop(), master_fd)
+            pty_output.watch_exit(p.sentinel)
+            output_task = asyncio.create_task(_forward_output(pty_output, websocket))
 
             # Seed stdin nếu có
             if stdin_seed:
                 try:
                     if not stdin_seed.endswith("\n"):
                         stdin_seed += "\n"
-                    os.write(master_fd, stdin_seed.encode("utf-8"))
+                    await _write_all(master_fd, stdin_seed.encode("utf-8"))
                 except Exception:
                     pass
 
             while True:
-                data = await websocket.receive_text()
+                data = await _receive_payload(websocket)
                 try:
-                    msg = json.loads(data)
+                    msg = _json_loads(data)
                     if isinstance(msg, dict) and msg.get("type") == "input":
-                        data = msg.get("data", "")
+                        data = msg.get("data", "").encode("utf-8")
                 except Exception:
                     pass
                 if data:
-                    os.write(master_fd, data.encode("utf-8"))
+                    await _write_all(master_fd, data)
 
         else:
             # Fallback: interactive shell mode
-            p = subprocess.Popen(
-                ["/bin/sh"],
-                preexec_fn=_preexec_with_ctty,
-                stdin=slave_fd,
-                stdout=slave_fd,
-                stderr=slave_fd,
-                universal_newlines=True,
-            )
+            p = await _start_pty_process(slave_fd, None)
 
             os.close(slave_fd)
             slave_fd = None
-            output_task = asyncio.create_task(_forward_output(master_fd, websocket))
-            monitor_task = asyncio.create_task(_monitor_process(p, websocket))
+            pty_output = _PtyOutput(asyncio.get_running_loop(), master_fd)
+            pty_output.watch_exit(p.sentinel)
+            output_task = asyncio.create_task(_forward_output(pty_output, websocket))
 
             # Forward first message to shell
             try:
                 if first_msg:
-                    os.write(master_fd, first_msg.encode("utf-8"))
+                    await _write_all(master_fd, first_msg)
             except Exception:
                 pass
 
             while True:
-                data = await websocket.receive_text()
-                os.write(master_fd, data.encode("utf-8"))
+                data = await _receive_payload(websocket)
+                await _write_all(master_fd, data)
 
     except WebSocketDisconnect:
         logger.info("Websocket disconnected")
     except Exception as e:
         logger.error(f"Websocket error: {e}")
-        if "EOF" in str(e):
-            # Child process thoát, ngắt kết nối websocket
-            if p is not None and p.poll() is None:
-                try:
-                    try:
-                        os.killpg(os.getpgid(p.pid), signal.SIGTERM)
-                    except Exception:
-                        p.terminate()
-                    p.wait(timeout=1)
-                except Exception:
-                    pass
-            try:
-                await websocket.close()
-            except Exception:
-                pass
     finally:
         logger.info("Cleaning up terminal session")
         if output_task is not None:
@@ -256,11 +577,9 @@ async def terminal_endpoint(websocket: WebSocket):
                 output_task.cancel()
             except Exception:
                 pass
-        if monitor_task is not None:
-            try:
-                monitor_task.cancel()
-            except Exception:
-                pass
+        if pty_output is not None:
+            # Gỡ reader khỏi event loop trước khi đóng fd
+            pty_output.close()
         if master_fd is not None:
             try:
                 os.close(master_fd)
@@ -271,21 +590,8 @@ async def terminal_endpoint(websocket: WebSocket):
                 os.close(slave_fd)
             except Exception:
                 pass
-        if p is not None and p.poll() is None:
-            try:
-                try:
-                    os.killpg(os.getpgid(p.pid), signal.SIGTERM)
-                except Exception:
-                    p.terminate()
-                p.wait(timeout=3)
-            except Exception:
-                pass
-        if code_file:
-            try:
-                if os.path.exists(code_file):
-                    os.remove(code_file)
-            except Exception:
-                pass
+        if p is not None:
+            await _terminate(p, timeout=3)
 
 @app.get("/")
 async def root():
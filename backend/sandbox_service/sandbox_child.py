@@ -0,0 +1,225 @@
+"""
+Code chạy trong tiến trình con của sandbox: worker /run và tiến trình terminal.
+Forkserver chỉ preload module này (+ vài module stdlib), không preload app.py:
+code sinh viên không thấy FastAPI app, pool, pty... của service. Chỉ dùng stdlib.
+"""
+import os
+import sys
+import io
+import fcntl
+import termios
+import signal
+import ctypes
+import builtins
+import linecache
+import threading
+import traceback
+import marshal
+import time
+import multiprocessing
+from multiprocessing import reduction, resource_tracker
+
+# Đọc output của worker qua pipe gắn thẳng vào fd 1/2
+CAPTURE_READ_BYTES = 64 * 1024
+# Giữ tối đa 1 MB mỗi luồng; phần vượt vẫn được đọc (không chặn chương trình) nhưng bỏ đi
+CAPTURE_MAX_BYTES = 1024 * 1024
+# Thời gian chờ tối đa (chung cho cả stdout và stderr) để đọc nốt output sau khi code chạy xong
+CAPTURE_FINISH_TIMEOUT = 1.0
+
+
+class _FdCapture:
+    """Trỏ fd (1 hoặc 2) vào 1 os.pipe; thread nền đọc pipe vào bytearray."""
+
+    def __init__(self, target_fd):
+        self._target_fd = target_fd
+        self._read_fd, write_fd = os.pipe()
+        os.dup2(write_fd, target_fd)
+        os.close(write_fd)
+        self._buf = bytearray()
+        self.truncated = False
+        self._thread = threading.Thread(target=self._drain, daemon=True)
+        self._thread.start()
+
+    def _drain(self):
+        while True:
+            chunk = os.read(self._read_fd, CAPTURE_READ_BYTES)
+            if not chunk:
+                break
+            room = CAPTURE_MAX_BYTES - len(self._buf)
+            if len(chunk) > room:
+                self.truncated = True
+                chunk = chunk[:room]
+            if chunk:
+                self._buf.extend(chunk)
+        os.close(self._read_fd)
+
+    def close(self):
+        """Đóng đầu ghi (fd đích): thread đọc gặp EOF khi không còn ai giữ pipe."""
+        os.close(self._target_fd)
+
+    def finish(self, deadline: float) -> str:
+        """Chờ đọc hết đến deadline (time.monotonic); decode 1 lần ở cuối."""
+        # Tiến trình con do code sinh viên tạo có thể còn giữ fd -> không chờ mãi
+        self._thread.join(max(0.0, deadline - time.monotonic()))
+        return bytes(self._buf).decode("utf-8", errors="replace")
+
+
+def execute_code_worker(code_bytes, stdin_input, result_conn):
+    # Ghi thẳng xuống pipe ở mức fd, không qua StringIO / redirect_stdout
+    stdout_capture = _FdCapture(1)
+    stderr_capture = _FdCapture(2)
+    stdout_stream = open(1, "w", encoding="utf-8", closefd=False)
+    stderr_stream = open(2, "w", encoding="utf-8", errors="backslashreplace", closefd=False)
+    sys.stdout = stdout_stream
+    sys.stderr = stderr_stream
+    if stdin_input:
+        stdin_input = stdin_input.replace("\\n", "\n")
+    sys.stdin = io.StringIO(stdin_input)
+    success = False
+    error_msg = None
+    try:
+        global_scope = {
+            "__builtins__": __builtins__,
+            "print": print, "input": input, "range": range, "len": len,
+        }
+        exec(marshal.loads(code_bytes), global_scope)
+        success = True
+    except Exception:
+        error_msg = traceback.format_exc()
+        success = False
+        stderr_stream.write(error_msg)
+    finally:
+        for stream in (stdout_stream, stderr_stream):
+            try:
+                stream.flush()
+            except Exception:
+                pass
+        stdout_capture.close()
+        stderr_capture.close()
+        # 1 deadline chung: fd bị giữ bởi tiến trình con thì tổng thời gian chờ vẫn chỉ là CAPTURE_FINISH_TIMEOUT
+        deadline = time.monotonic() + CAPTURE_FINISH_TIMEOUT
+        stdout = stdout_capture.finish(deadline)
+        stderr = stderr_capture.finish(deadline)
+        result_conn.send({
+            "stdout": stdout,
+            "stderr": stderr,
+            "success": success,
+            "error": error_msg,
+            "truncated": stdout_capture.truncated or stderr_capture.truncated,
+        })
+
+
+PR_SET_PDEATHSIG = 1
+
+
+def _die_with_parent(parent_pid):
+    """
+    prctl(PR_SET_PDEATHSIG, SIGKILL): kernel tự kill tiến trình con khi tiến trình cha chết
+    (service crash / bị kill) -> không bỏ lại worker hay chương trình sinh viên mồ côi.
+    parent_pid do service lấy trước start(): đọc getppid() sau fork thì cha có thể đã chết từ trước.
+    """
+    try:
+        # CDLL(None): libc đang chạy (glibc hoặc musl trên Alpine)
+        ctypes.CDLL(None, use_errno=True).prctl(PR_SET_PDEATHSIG, signal.SIGKILL, 0, 0, 0)
+    except Exception:
+        return
+    if os.getppid() != parent_pid:
+        # Cha đã chết trước khi prctl có hiệu lực
+        os._exit(1)
+
+
+def _close_inherited_fds(*keep):
+    """Đóng mọi fd >= 3 trừ keep: code sinh viên không chạm được fd nào khác của forkserver / service."""
+    low = 3
+    for fd in sorted(fd for fd in keep if fd >= 3):
+        os.closerange(low, fd)
+        low = fd + 1
+    os.closerange(low, os.sysconf("SC_OPEN_MAX"))
+
+
+def _reset_multiprocessing():
+    """
+    fd của resource tracker vừa bị đóng; code sinh viên dùng multiprocessing thì fork thẳng
+    và để tracker tự khởi động lại thay vì dùng lại fd đã đóng / context forkserver của service.
+    """
+    resource_tracker._resource_tracker._fd = None
+    multiprocessing.set_start_method("fork", force=True)
+
+
+def pool_worker(parent_pid, job_conn, result_conn):
+    """Chờ 1 job (code đã marshal, stdin) qua pipe, chạy và gửi kết quả về rồi thoát."""
+    _die_with_parent(parent_pid)
+    # Group riêng: xong job, service kill cả group (kể cả tiến trình con code sinh viên tạo ra)
+    os.setsid()
+    _close_inherited_fds(job_conn.fileno(), result_conn.fileno())
+    # fd 0 từ forkserver là socket của nó -> thay bằng /dev/null (stdin thật đi qua job)
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    if devnull != 0:
+        os.dup2(devnull, 0)
+        os.close(devnull)
+    _reset_multiprocessing()
+    try:
+        code_bytes, stdin_input = job_conn.recv()
+    except EOFError:
+        return
+    execute_code_worker(code_bytes, stdin_input, result_conn)
+    result_conn.close()
+
+
+# Tiến trình terminal không ghi file tạm, không khởi động lại interpreter python3 cho mỗi phiên
+PTY_CODE_FILENAME = "main.py"
+
+
+class PassFd:
+    """Bọc fd để gửi sang tiến trình con của forkserver (multiprocessing dup fd qua unix socket)."""
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    def __reduce__(self):
+        return PassFd._rebuild, (reduction.DupFd(self.fd),)
+
+    @staticmethod
+    def _rebuild(dup_fd):
+        return PassFd(dup_fd.detach())
+
+
+def pty_child(parent_pid, slave, code):
+    """
+    Tiến trình con của terminal: lấy pty slave làm controlling terminal + stdin/stdout/stderr,
+    rồi exec code (chế độ chạy code) hoặc /bin/sh (code là None).
+    """
+    _die_with_parent(parent_pid)
+    os.setsid()
+    try:
+        fcntl.ioctl(slave.fd, termios.TIOCSCTTY, 0)
+    except Exception:
+        pass
+    for target_fd in (0, 1, 2):
+        os.dup2(slave.fd, target_fd)
+    # Chỉ giữ 0/1/2 (pty slave)
+    _close_inherited_fds()
+
+    if code is None:
+        os.execv("/bin/sh", ["/bin/sh"])
+
+    _reset_multiprocessing()
+    # Tương đương python3 -u: stdout/stderr ghi thẳng xuống pty
+    sys.stdin = open(0, "r", encoding="utf-8", closefd=False)
+    sys.stdout = io.TextIOWrapper(io.FileIO(1, "w", closefd=False), encoding="utf-8", write_through=True)
+    sys.stderr = io.TextIOWrapper(
+        io.FileIO(2, "w", closefd=False), encoding="utf-8", errors="backslashreplace", write_through=True
+    )
+    # sys.argv kế thừa từ tiến trình service (dòng lệnh uvicorn): đặt lại như khi chạy `python -u main.py`
+    sys.argv = [PTY_CODE_FILENAME]
+    # Traceback hiển thị được dòng code dù không có file trên đĩa
+    linecache.cache[PTY_CODE_FILENAME] = (len(code), None, code.splitlines(True), PTY_CODE_FILENAME)
+    try:
+        exec(compile(code, PTY_CODE_FILENAME, "exec"), {"__name__": "__main__", "__builtins__": builtins})
+    except SystemExit:
+        raise
+    except BaseException:
+        # Bỏ frame của pty_child, chỉ in phần traceback của code sinh viên
+        etype, value, tb = sys.exc_info()
+        traceback.print_exception(etype, value, tb.tb_next)
+        sys.exit(1)
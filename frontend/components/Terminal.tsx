@@ -123,10 +123,8 @@ const Terminal: React.FC<TerminalProps> = ({
     };
 
     ws.onmessage = (ev) => {
-      const data = typeof ev.data === 'string'
-        ? ev.data
-        : new TextDecoder().decode(ev.data);
-      term.write(data);
+      // Output được gửi dạng binary frame: xterm tự decode UTF-8 (kể cả ký tự bị cắt giữa 2 frame)
+      term.write(typeof ev.data === 'string' ? ev.data : new Uint8Array(ev.data));
     };
 
     ws.onclose = () => {